@@ -244,7 +244,7 @@ class ProductAdmin(getParentClass('ModelAdmin', Product)):
                             variation.price = variation.price * percent_multiplier
                             if variation.discount_price:
                                 variation.discount_price = variation.discount_price * percent_multiplier
-                            variation.save()
+                            variation.save(update_min_price=False)
                     obj.save()
 
                 self.message_user(request, _(u"Successfully changed prices."))
@@ -273,7 +273,7 @@ class ProductAdmin(getParentClass('ModelAdmin', Product)):
                     if obj.has_variations:
                         for variation in obj.get_variations():
                             variation.discount_price = get_price(variation.price)
-                            variation.save()
+                            variation.save(update_min_price=False)
                     obj.save()
 
                 self.message_user(request, _(u"Successfully set discounts."))
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class QshopConfig(AppConfig):
     name = 'qshop'
     verbose_name = 'E-shop'
+
+    def ready(self):
+        from . import signals
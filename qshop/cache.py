@@ -0,0 +1,90 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import get_language
+
+from .qshop_settings import CACHE_ALIAS
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def make_key(*parts):
+    return 'qshop:{0}'.format(':'.join([str(part) for part in parts]))
+
+
+# Generations are counters stored in cache. They are part of every cache key
+# built with category_cache_key(), so bumping a generation invalidates all
+# entries built on top of it without having to know their exact keys.
+
+def get_generation(*parts):
+    key = make_key('generation', *parts)
+    cache = get_cache()
+    generation = cache.get(key)
+    if generation is None:
+        generation = 1
+        cache.add(key, generation, None)
+    return generation
+
+
+def bump_generation(*parts):
+    key = make_key('generation', *parts)
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
+
+
+def bump_categories(category_ids):
+    for category_id in set(category_ids):
+        bump_generation('category', category_id)
+
+
+def category_cache_key(name, category_id, *parts):
+    cache = get_cache()
+    catalog_key = make_key('generation', 'catalog')
+    category_key = make_key('generation', 'category', category_id)
+    generations = cache.get_many([catalog_key, category_key])
+    return make_key(
+        name,
+        category_id,
+        generations.get(catalog_key) or get_generation('catalog'),
+        generations.get(category_key) or get_generation('category', category_id),
+        *parts
+    )
+
+
+def page_cache_key(name, category_id, *parts):
+    """
+    Key for rendered pages, additionally reset when menu or currencies change.
+    """
+    return category_cache_key(name, category_id, get_generation('pages'), *parts)
+
+
+def product_url_cache_keys(product_ids, language=None):
+    """
+    Keys of canonical product urls, reset all at once by 'urls' generation.
+    """
+    generation = get_generation('urls')
+    language = language or get_language()
+    return {product_id: make_key('url', generation, language, product_id) for product_id in product_ids}
+
+
+def delete_product_urls(product_ids):
+    languages = set([settings.LANGUAGE_CODE] + [code for code, name in settings.LANGUAGES])
+    keys = []
+    for language in languages:
+        keys.extend(product_url_cache_keys(product_ids, language).values())
+    get_cache().delete_many(keys)
+
+
+def articul_cache_key(articul):
+    articul_hash = hashlib.md5(articul.encode('utf-8')).hexdigest()
+    return make_key('articul', get_generation('articuls'), articul_hash)
+
+
+def delete_articuls(articuls):
+    get_cache().delete_many([articul_cache_key(articul) for articul in set(articuls) if articul])
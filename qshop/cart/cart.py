@@ -1,22 +1,40 @@
 from decimal import Decimal
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.template.loader import render_to_string
 
 from . import models
-from ..models import Currency
+from ..cache import get_generation
+from ..models import Currency, CurrencyAbstract, Product, ProductVariation
 from qshop import qshop_settings
 
 from sitemenu import import_item
 count_delivery_price = import_item(qshop_settings.CART_DELIVERY_FUNCTION)
 
 CART_ID = '%s-cart' % settings.ROOT_URLCONF
+CART_PRICES_VERSION = '%s-cart-prices' % settings.ROOT_URLCONF
+CART_SESSION_ITEMS = '%s-cart-items' % settings.ROOT_URLCONF  # used by SessionCartAbstract
 
 
 if not hasattr(settings, 'SITE_URL'):
     raise Exception('No SITE_URL defined in settings! (SITE_URL="http://example.com")')
 
 
+def summary_in_current_currency():
+    """
+    Cart summary (in default currency) can be used as is only while prices
+    aren't converted, otherwise every line is converted like it is shown.
+    """
+    currency = Currency.get_default_currency()
+    return (
+        currency.is_default and currency.get_rate() == 1 and
+        Currency.get_price is CurrencyAbstract.get_price and
+        Currency.get_price_notoverloadable is CurrencyAbstract.get_price_notoverloadable
+    )
+
+
 class ItemAlreadyExists(Exception):
     pass
 
@@ -52,14 +70,38 @@ class CartAbstract:
             yield item
 
     def update_prices(self):
-        if self.cart.id:
-            items = []
-            for item in self.get_products():
-                self.check_item(item)
-                if item.id:
-                    item.unit_price = item.get_product().get_price(default_currency=True)
+        """
+        Sets actual product prices to cart items. Runs at most once per request
+        and, with QSHOP_CART_REPRICE_ON_PRICE_CHANGE_ONLY, is skipped while
+        product prices weren't changed since the last run (unless check_item
+        is overloaded), only changed items are saved.
+        """
+        if not self.cart.id:
+            return
+        request = self._request
+        if getattr(request, '_qshop_cart_prices_updated', None) == self.cart.id:
+            return
+        request._qshop_cart_prices_updated = self.cart.id
+
+        if qshop_settings.CART_REPRICE_ON_PRICE_CHANGE_ONLY:
+            prices_version = [self.cart.id, get_generation('prices')]
+            check_items = type(self).check_item is not CartAbstract.check_item
+            if not check_items and request.session.get(CART_PRICES_VERSION) == prices_version:
+                return
+
+        items = []
+        for item in self.get_products():
+            self.check_item(item)
+            if item.id:
+                unit_price = Decimal(str(item.get_product().get_price(default_currency=True))).quantize(Decimal('0.01'))
+                if unit_price != item.unit_price:
+                    item.unit_price = unit_price
                     items.append(item)
+        if items:
             models.Item.objects.bulk_update(items, ['unit_price'])
+            self.cart.update_summary()
+        if qshop_settings.CART_REPRICE_ON_PRICE_CHANGE_ONLY and request.session.get(CART_PRICES_VERSION) != prices_version:
+            request.session[CART_PRICES_VERSION] = prices_version
 
     def check_item(self, item):
         pass
@@ -69,11 +111,13 @@ class CartAbstract:
             return self._products
         except Exception:
             if self.cart.id:
-                self._products = self.cart.item_set.all().select_related('_real_product')
+                self._products = self.cart.item_set.all().select_related('_real_product', '_real_product_variation')
                 return self._products
         return []
 
     def total_price_wo_discount_wo_vat_reduction(self, in_default_currency=False):
+        if self.cart.id and (in_default_currency or summary_in_current_currency()):
+            return float(self.cart.get_summary()['price'])
         total_price = 0
         for item in self.get_products():
             total_price += item.total_price_wo_discount(in_default_currency=in_default_currency)
@@ -136,11 +180,15 @@ class CartAbstract:
         return Currency.get_fprice(self.delivery_price(), format_only=True)
 
     def has_discount(self):
+        if qshop_settings.ENABLE_PROMO_CODES and self.cart.id:
+            return self.cart.get_summary()['discount'] > 0
         if self.get_discount() > 0:
             return True
         return False
 
     def get_discount(self):
+        if qshop_settings.ENABLE_PROMO_CODES and self.cart.id:
+            return self.cart.get_discount(items=self.get_products())
         return self.cart.get_discount()
 
     def get_fdiscount(self):
@@ -155,6 +203,7 @@ class CartAbstract:
 
         # self.clear_cache()
         self.cart.save()
+        self.update_summary()
 
     def set_vat_reduction(self, percents):
         self.cart.vat_reduction = percents
@@ -170,6 +219,8 @@ class CartAbstract:
         return False
 
     def total_weight(self):
+        if self.cart.id:
+            return self.cart.get_summary()['weight']
         try:
             return self._total_weight
         except Exception:
@@ -183,15 +234,13 @@ class CartAbstract:
         return "%.2f" % self.total_weight()
 
     def total_products(self):
-        try:
-            return self._count
-        except Exception:
-            if self.cart.id:
-                self._count = self.cart.item_set.count()
-                return self._count
+        if self.cart.id:
+            return self.cart.get_summary()['count']
         return 0
 
     def total_products_with_qty(self):
+        if self.cart.id:
+            return self.cart.get_summary()['quantity']
         try:
             return self._count_with_qty
         except Exception:
@@ -216,67 +265,187 @@ class CartAbstract:
         self.clear_cache()
         if int(quantity) <= 0:
             return False
-        try:
-            item = models.Item.objects.get(
-                cart=self.cart,
-                product=product,
-            )
-        except models.Item.DoesNotExist:
-            item = models.Item()
-            item.cart = self.cart
-            item.product = product
-            item.unit_price = product.get_price(default_currency=True)
-            item.quantity = quantity
-            item.product_variation = product.selected_variation
-            if item.product.can_be_purchased(item.quantity):
-                item.save()
-            else:
-                e = ItemTooMany('Lack in stock!')
-                e.product = item.product
-                raise e
-        else:
-            item.quantity += int(quantity)
-            if item.product.can_be_purchased(item.quantity):
-                item.save()
+        with transaction.atomic(), models.suspend_summary(self.cart.id):
+            try:
+                item = models.Item.objects.get(
+                    cart=self.cart,
+                    product=product,
+                )
+            except models.Item.DoesNotExist:
+                item = models.Item()
+                item.cart = self.cart
+                item.product = product
+                item.unit_price = product.get_price(default_currency=True)
+                item.quantity = quantity
+                item.product_variation = product.selected_variation
+                if item.product.can_be_purchased(item.quantity):
+                    item.save()
+                else:
+                    e = ItemTooMany('Lack in stock!')
+                    e.product = item.product
+                    raise e
             else:
-                e = ItemTooMany('Lack in stock!')
-                e.product = item.product
-                raise e
+                item.quantity += int(quantity)
+                if item.product.can_be_purchased(item.quantity):
+                    item.save()
+                else:
+                    e = ItemTooMany('Lack in stock!')
+                    e.product = item.product
+                    raise e
+            self.update_summary()
         return True
 
+    def iter_lines(self, lines, failed=None, not_found=None):
+        """
+        lines - iterable of (product or product id, variation id, quantity).
+        Yields (product with selected variation, quantity) for every line
+        with positive quantity, products and their variations are loaded
+        with one query each. Without variation id product gets its first
+        variation (like select_variation). Products with variation id which
+        isn't one of their variations are added to failed list and ids of
+        missing products to not_found list (if given) instead.
+        """
+        lines = [(getattr(product, 'pk', product), variation_id, int(quantity)) for product, variation_id, quantity in lines]
+        lines = [line for line in lines if line[2] > 0]
+        if not lines:
+            return
+        product_ids = [line[0] for line in lines]
+        products = Product.objects.in_bulk(product_ids)
+        variations = {}
+        for variation in ProductVariation.objects.filter(product_id__in=product_ids).select_related('variation'):
+            variations.setdefault(variation.product_id, []).append(variation)
+
+        for product_id, variation_id, quantity in lines:
+            product = products.get(product_id)
+            if not product:
+                if not_found is not None:
+                    not_found.append(product_id)
+                continue
+            product.selected_variation = None
+            if product.has_variations and variations.get(product.pk):
+                if variation_id in (None, ''):
+                    product.selected_variation = variations[product.pk][0]
+                else:
+                    for variation in variations[product.pk]:
+                        if str(variation.pk) == str(variation_id):
+                            product.selected_variation = variation
+                    if product.selected_variation is None:
+                        if failed is not None:
+                            failed.append(product)
+                        continue
+            yield product, quantity
+
+    def add_many(self, lines, not_found=None):
+        """
+        Adds many products at once (see iter_lines for lines format), existing
+        items are loaded with one query and all changes are saved with
+        bulk_create/bulk_update in one transaction.
+        Returns list of products which weren't added due to lack in stock or
+        wrong variation, ids of missing products are added to not_found list.
+        """
+        self.create_cart()
+        self.clear_cache()
+        failed = []
+        with transaction.atomic():
+            items = {}
+            for item in self.cart.item_set.all():
+                items[(item._real_product_id, item._real_product_variation_id)] = item
+            new_items = []
+            changed_items = {}
+            for product, quantity in self.iter_lines(lines, failed, not_found):
+                key = (product.pk, product.selected_variation.pk if product.selected_variation else None)
+                item = items.get(key)
+                if not product.can_be_purchased((item.quantity if item else 0) + quantity):
+                    failed.append(product)
+                    continue
+                if item is None:
+                    item = models.Item(cart=self.cart, quantity=0, unit_price=product.get_price(default_currency=True))
+                    item.product = product
+                    items[key] = item
+                    new_items.append(item)
+                elif item.pk:
+                    changed_items[key] = item
+                item.quantity += quantity
+            models.Item.objects.bulk_create(new_items)
+            models.Item.objects.bulk_update(list(changed_items.values()), ['quantity'])
+            self.update_summary()
+        return failed
+
     def remove(self, item_id):
         self.clear_cache()
-        try:
-            item = models.Item.objects.get(
-                cart=self.cart,
-                pk=item_id,
-            )
-        except models.Item.DoesNotExist:
-            pass
-        else:
-            item.delete()
-        if self.total_products() == 0:
-            self.cart.delete()
-            del self._request.session[CART_ID]
+        with transaction.atomic(), models.suspend_summary(self.cart.id):
+            try:
+                item = models.Item.objects.get(
+                    cart=self.cart,
+                    pk=item_id,
+                )
+            except models.Item.DoesNotExist:
+                pass
+            else:
+                item.delete()
+            self.update_summary()
+            if self.total_products() == 0:
+                self.cart.delete()
+                del self._request.session[CART_ID]
 
     def update(self, item_id, quantity):
         self.clear_cache()
         if quantity <= 0:
             return self.remove(item_id)
-        try:
-            item = models.Item.objects.get(
-                cart=self.cart,
-                pk=item_id,
+        with transaction.atomic(), models.suspend_summary(self.cart.id):
+            try:
+                item = models.Item.objects.get(
+                    cart=self.cart,
+                    pk=item_id,
+                )
+                item.quantity = int(quantity)
+                if item.product.can_be_purchased(item.quantity):
+                    item.save()
+                else:
+                    e = ItemTooMany('Lack in stock!')
+                    e.product = item.product
+                    raise e
+            except models.Item.DoesNotExist:
+                pass
+            self.update_summary()
+
+    def update_many(self, quantities):
+        """
+        quantities - dict of item id: quantity, items with zero quantity are
+        removed. Items are loaded with one query, stock is checked with
+        Product.can_be_purchased_bulk and changes are saved with one
+        bulk_update and one delete.
+        Returns list of products which weren't updated due to lack in stock.
+        """
+        self.clear_cache()
+        if not self.cart.id:
+            return []
+        with transaction.atomic(), models.suspend_summary(self.cart.id):
+            items = list(
+                self.cart.item_set.filter(pk__in=quantities.keys()).select_related('_real_product', '_real_product_variation')
             )
-            item.quantity = int(quantity)
-            if item.product.can_be_purchased(item.quantity):
-                item.save()
-            else:
-                e = ItemTooMany('Lack in stock!')
-                e.product = item.product
-                raise e
-        except models.Item.DoesNotExist:
-            pass
+            removed_ids = [item.pk for item in items if quantities[item.pk] <= 0]
+            changed_items = [item for item in items if 0 < quantities[item.pk] != item.quantity]
+            lines = [(item.product, quantities[item.pk]) for item in changed_items]
+            failed = Product.can_be_purchased_bulk(lines)
+            failed_ids = {id(product) for product in failed}
+            changed_items = [item for item in changed_items if id(item._real_product) not in failed_ids]
+            for item in changed_items:
+                item.quantity = quantities[item.pk]
+
+            models.Item.objects.bulk_update(changed_items, ['quantity'])
+            if removed_ids:
+                self.cart.item_set.filter(pk__in=removed_ids).delete()
+            self.update_summary()
+            if self.total_products() == 0:
+                self.cart.delete()
+                del self._request.session[CART_ID]
+        return failed
+
+    def update_summary(self):
+        if self.cart.id:
+            self.cart.update_summary()
+        self.clear_cache()
 
     def clear_cache(self):
         if hasattr(self, '_products'):
@@ -285,15 +454,42 @@ class CartAbstract:
             del self._delivery_price
         if hasattr(self, '_total_weight'):
             del self._total_weight
-        if hasattr(self, '_count'):
-            del self._count
         if hasattr(self, '_count_with_qty'):
             del self._count_with_qty
 
     def clear(self):
-        for item in self.cart.item_set.all():
-            item.delete()
-        self.clear_cache()
+        with transaction.atomic(), models.suspend_summary(self.cart.id):
+            for item in self.cart.item_set.all():
+                item.delete()
+            self.update_summary()
+
+    def as_dict(self):
+        """
+        Cart contents and totals with formatted prices, used by JSON cart views.
+        """
+        items = []
+        for item in self.get_products():
+            product = item.product
+            items.append({
+                'id': item.pk,
+                'product': product.pk,
+                'variation': product.selected_variation.pk if product.selected_variation else None,
+                'name': product.name,
+                'variation_name': product.selected_variation.name if product.selected_variation else None,
+                'quantity': item.quantity,
+                'price': Currency.get_fprice(item.single_price(), format_only=True),
+                'total_price': item.total_fprice(),
+                'remove_url': item.get_cartremove_url(),
+            })
+        return {
+            'items': items,
+            'total_products': self.total_products(),
+            'total_products_with_qty': self.total_products_with_qty(),
+            'total_price_wo_discount': self.total_fprice_wo_discount(),
+            'discount': self.get_fdiscount() if self.has_discount() else None,
+            'total_price': self.total_fprice(),
+            'currency': self.get_currency().code,
+        }
 
     def as_table(self, standalone=False):
         link_add = ''
@@ -307,14 +503,57 @@ class CartAbstract:
             'cart': self,
         })
 
+    def reserve_stock(self):
+        """
+        Takes quantities of all items from stock with conditional UPDATE
+        (stock >= quantity) in one transaction, so concurrent checkouts can't
+        oversell. Either all items are reserved or ItemTooMany is raised and
+        nothing is changed. Reservations of unpaid orders expire, see
+        qshop_release_stock command.
+        """
+        items = sorted(self.get_products(), key=lambda item: (item._real_product_id, item._real_product_variation_id or 0))
+        reservations = []
+        with transaction.atomic():
+            for item in items:
+                reservation = models.StockReservation(
+                    cart=self.cart,
+                    product_id=item._real_product_id,
+                    product_variation_id=item._real_product_variation_id,
+                    quantity=item.quantity,
+                    confirmed=not qshop_settings.ENABLE_PAYMENTS,
+                )
+                stock_model, pk = reservation.get_stock_model_and_pk()
+                if not stock_model.objects.filter(pk=pk, stock__gte=item.quantity).update(stock=F('stock') - item.quantity):
+                    e = ItemTooMany('Lack in stock!')
+                    e.product = item.product
+                    raise e
+                reservations.append(reservation)
+            models.StockReservation.objects.bulk_create(reservations)
+
     def checkout(self):
-        self.cart.checked_out = True
-        self.cart.save()
+        with transaction.atomic():
+            if qshop_settings.STOCK_RESERVATION_ENABLED and not self.cart.checked_out:
+                self.reserve_stock()
+            self.cart.checked_out = True
+            self.cart.save()
 
     def set_promo_code(self, promo_code):
         self.cart.promo_code = promo_code
         self.cart.save()
+        self.update_summary()
 
 
 class Cart(import_item(qshop_settings.CART_CLASS) if qshop_settings.CART_CLASS else CartAbstract):
     pass
+
+
+def get_cart(request):
+    """
+    Returns cart of current request. It is created once per request and shared
+    by views and template tags, so cart and its items are loaded only once.
+    """
+    try:
+        return request._qshop_cart
+    except AttributeError:
+        request._qshop_cart = Cart(request)
+        return request._qshop_cart
@@ -1,4 +1,5 @@
 from django import forms
+from django.db import transaction
 from django.db.models import Q
 from django.utils.translation import gettext as _
 from qshop.qshop_settings import DELIVERY_REQUIRED, ENABLE_PAYMENTS, ENABLE_QSHOP_DELIVERY
@@ -191,6 +192,9 @@ if ENABLE_QSHOP_DELIVERY:
         def save(self, commit=True):
             if DELIVERY_REQUIRED:
                 self.instance.is_delivery = Order.DELIVERY_YES
-            instance = super().save(commit)
-            self.cart.checkout()
+            with transaction.atomic():
+                self.cart.create_cart()
+                self.instance.cart = self.cart.cart
+                instance = super().save(commit)
+                self.cart.checkout()
             return instance
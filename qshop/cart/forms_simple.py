@@ -1,4 +1,5 @@
 from django import forms
+from django.db import transaction
 from django.utils.translation import gettext as _
 from qshop.qshop_settings import ENABLE_PROMO_CODES
 
@@ -15,20 +16,22 @@ class OrderBaseForm(forms.ModelForm):
         kwargs['commit'] = False
         order = super(OrderBaseForm, self).save(*args, **kwargs)
 
+        cart.create_cart()
         order.cart = cart.cart
         order.cart_text = cart.as_table(standalone=True)
 
         order.save()
 
         if hasattr(order, 'email'):
-            sendMail(
+            # order is saved in one transaction with stock reservation, mail is sent only if it is committed
+            transaction.on_commit(lambda: sendMail(
                 'order_sended',
                 variables={
                     'order': order,
                 },
                 subject=_("Your order %s accepted") % order.get_id(),
                 mails=[order.email]
-            )
+            ))
 
         return order
 
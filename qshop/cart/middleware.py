@@ -0,0 +1,14 @@
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_cart
+
+
+class CartMiddleware(MiddlewareMixin):
+    """
+    Adds request.cart, the cart is loaded on first use and is the same object
+    that views and template tags get with get_cart(request).
+    """
+
+    def process_request(self, request):
+        request.cart = SimpleLazyObject(lambda: get_cart(request))
@@ -1,11 +1,17 @@
 import datetime
 import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from decimal import Decimal
 
 import requests
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from qshop.qshop_settings import REDIRECT_CLASS
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 from qshop import qshop_settings
@@ -23,6 +29,22 @@ if qshop_settings.ENABLE_PAYMENTS:
 if qshop_settings.ENABLE_PROMO_CODES:
     from qshop.models import PromoCode
 
+# ids of carts which summary isn't updated on their items changes
+suspended_summary_carts = ContextVar('qshop_suspended_summary_carts', default=frozenset())
+
+
+@contextmanager
+def suspend_summary(*cart_ids):
+    """
+    Items of given carts don't update summary of their cart while saved or
+    deleted inside this block (cart is deleted or summary is updated after).
+    """
+    token = suspended_summary_carts.set(suspended_summary_carts.get().union(cart_ids))
+    try:
+        yield
+    finally:
+        suspended_summary_carts.reset(token)
+
 
 class CartAbstract(models.Model):
     date_added = models.DateTimeField(_('creation date'), auto_now_add=True)
@@ -33,6 +55,13 @@ class CartAbstract(models.Model):
     if qshop_settings.ENABLE_PROMO_CODES:
         promo_code = models.ForeignKey(PromoCode, on_delete=models.SET_NULL, null=True, blank=True, related_name="promocode")
 
+    # summary of items in default currency, updated by update_summary() on every cart change (None - not counted yet)
+    items_count = models.PositiveIntegerField(_('items count'), null=True, editable=False)
+    items_quantity = models.PositiveIntegerField(_('items quantity'), null=True, editable=False)
+    items_price = models.DecimalField(_('items price'), max_digits=12, decimal_places=2, null=True, editable=False)
+    items_weight = models.FloatField(_('items weight'), null=True, editable=False)
+    items_discount = models.DecimalField(_('items discount'), max_digits=12, decimal_places=2, null=True, editable=False)
+
     class Meta:
         abstract = True
         verbose_name = _('cart')
@@ -59,26 +88,133 @@ class CartAbstract(models.Model):
         return "-"
     get_order_html.short_description = "Order ID"
 
-    def get_discount(self, in_default_currency=False):
+    def delete(self, *args, **kwargs):
+        with suspend_summary(self.pk):
+            return super(CartAbstract, self).delete(*args, **kwargs)
+
+    def update_summary(self):
+        summary = self.item_set.aggregate(
+            items_count=models.Count('id'),
+            items_quantity=models.Sum('quantity'),
+            items_price=models.Sum(models.F('quantity') * models.F('unit_price'), output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+            items_weight=models.Sum(models.F('quantity') * models.F('_real_product__weight'), output_field=models.FloatField()),
+        )
+        summary['items_quantity'] = summary['items_quantity'] or 0
+        summary['items_price'] = Decimal(summary['items_price'] or 0).quantize(Decimal('0.01'))
+        summary['items_weight'] = summary['items_weight'] or 0
+        for field_name, value in summary.items():
+            setattr(self, field_name, value)
+
+        if qshop_settings.ENABLE_PROMO_CODES:
+            self.items_discount = Decimal('0')  # promo discount reads the summary
+            self.items_discount = Decimal(self.get_discount(in_default_currency=True)).quantize(Decimal('0.01'))
+        else:
+            self.items_discount = (self.items_price * self.discount / 100).quantize(Decimal('0.01'))
+        # date_modified is kept actual for delete_stale()
+        self.date_modified = timezone.now()
+        type(self).objects.filter(pk=self.pk).update(items_discount=self.items_discount, date_modified=self.date_modified, **summary)
+
+    @classmethod
+    def delete_stale(cls, older_than, batch_size=1000, pause=0, callback=None):
+        """
+        Deletes carts (and their items) which weren't checked out and weren't
+        modified since older_than datetime. Carts are selected by primary key
+        ranges and deleted in short transactions of batch_size carts, sleeping
+        pause seconds between batches, so tables aren't locked for long.
+        callback(deleted_carts, deleted_items) is called after every batch.
+        Returns (deleted_carts, deleted_items).
+        """
+        stale = cls.objects.filter(checked_out=False, date_modified__lt=older_than, order__isnull=True).order_by('pk')
+        deleted_carts = deleted_items = 0
+        last_pk = 0
+        while True:
+            ids = list(stale.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            with transaction.atomic(), suspend_summary(*ids):
+                # staleness is checked again, carts changed since ids were selected are kept
+                ids = list(stale.filter(pk__in=ids).values_list('pk', flat=True))
+                deleted_items += Item.objects.filter(cart_id__in=ids).delete()[0]
+                deleted_carts += stale.filter(pk__in=ids).delete()[0]
+            if callback:
+                callback(deleted_carts, deleted_items)
+            if pause:
+                time.sleep(pause)
+        return deleted_carts, deleted_items
+
+    def get_summary(self):
+        if self.items_count is None or self.items_discount is None:
+            self.update_summary()
+        return {
+            'count': self.items_count,
+            'quantity': self.items_quantity,
+            'price': self.items_price,
+            'weight': self.items_weight,
+            'discount': self.items_discount,
+        }
+
+    def get_discount(self, in_default_currency=False, items=None):
         if qshop_settings.ENABLE_PROMO_CODES:
-            discount = Decimal('0')
-            for item in self.item_set.all():
-                discount += item.total_discount(in_default_currency)
-            return discount
+            return sum(self.get_promo_allocation(items, in_default_currency).values(), Decimal('0'))
         return self.discount
 
     if qshop_settings.ENABLE_PROMO_CODES:
+        def get_promo_discount_percent(self):
+            """
+            Returns percent of discount which promo code gives to every item,
+            it is counted once per cart state (promo code, items sum, currency).
+            """
+            subtotal = self.get_cartobject().total_price_wo_discount_wo_vat_reduction()
+            state = (self.promo_code_id, subtotal, Currency.get_default_currency().code)
+            cached = getattr(self, '_promo_discount_percent', None)
+            if cached and cached[0] == state:
+                return cached[1]
+
+            discount_percent = 0
+            if self.can_use_promocode:
+                promo_code = self.promo_code
+                if promo_code.is_percent_discount:
+                    discount_percent = promo_code.discount
+                else:
+                    discount_percent = self.discount_percent_from_fixed_discount
+            self._promo_discount_percent = (state, discount_percent)
+            return discount_percent
+
+        def get_promo_allocation(self, items=None, in_default_currency=False):
+            """
+            Returns {item id: total discount of item} for all items of the cart
+            in one pass over them (items - already loaded items of this cart).
+            """
+            if items is None:
+                items = self.item_set.all()
+            items = list(items)
+            discount_percent = self.get_promo_discount_percent()
+            state = (
+                tuple((item.pk, item.quantity, item.unit_price) for item in items),
+                discount_percent,
+                in_default_currency,
+                Currency.get_default_currency().code,
+            )
+            cached = getattr(self, '_promo_allocation', None)
+            if cached and cached[0] == state:
+                return cached[1]
+
+            allocation = {}
+            for item in items:
+                # items of this cart read the discount percent counted above
+                item.cart = self
+                allocation[item.pk] = item.total_discount(in_default_currency)
+            self._promo_allocation = (state, allocation)
+            return allocation
+
         @property
         def can_use_promocode(self):
-            try:
-                return self.__can_use_promocode
-            except Exception:
-                self.__can_use_promocode = (
-                    self.promo_code
-                    and self.get_cartobject().total_price_wo_discount_wo_vat_reduction() > self.promo_code.min_sum
-                    and self.promo_code.is_active
-                )
-                return self.__can_use_promocode
+            return bool(
+                self.promo_code
+                and self.get_cartobject().total_price_wo_discount_wo_vat_reduction() > self.promo_code.min_sum
+                and self.promo_code.is_active
+            )
 
         @property
         def discount_percent_from_fixed_discount(self):
@@ -134,13 +270,7 @@ class ItemAbstract(models.Model):
     if qshop_settings.ENABLE_PROMO_CODES:
 
         def discount_percent(self, in_default_currency=False):
-            discount_percent = 0
-            if self.cart.can_use_promocode:
-                if self.cart.promo_code.is_percent_discount:
-                    discount_percent = self.cart.promo_code.discount
-                else:
-                    discount_percent = self.get_discount_percent_from_fixed_discount(in_default_currency)
-            return discount_percent
+            return self.cart.get_promo_discount_percent()
 
         def get_discount_percent_from_fixed_discount(self, in_default_currency=False):
             return self.cart.discount_percent_from_fixed_discount
@@ -243,6 +373,8 @@ class OrderAbstract(models.Model):
         def user_paid(self):
             self.status = 2
             self.paid = True
+            if qshop_settings.STOCK_RESERVATION_ENABLED:
+                self.cart.stockreservation_set.update(confirmed=True)
 
 
 class OrderAbstractDefault(OrderAbstract):
@@ -632,6 +764,55 @@ if qshop_settings.ENABLE_QSHOP_DELIVERY:
         pass
 
 
+if qshop_settings.STOCK_RESERVATION_ENABLED:
+    class StockReservationQuerySet(models.QuerySet):
+        def expired(self):
+            """
+            Unconfirmed reservations older than STOCK_RESERVATION_TIMEOUT and
+            reservations of canceled orders.
+            """
+            date = timezone.now() - datetime.timedelta(seconds=qshop_settings.STOCK_RESERVATION_TIMEOUT)
+            return self.filter(confirmed=False).filter(models.Q(date_added__lt=date) | models.Q(cart__order__status=4))
+
+        def release(self):
+            """
+            Returns reserved quantities to stock and deletes reservations.
+            """
+            # ids are collected first, rows are locked with plain query (no joins and DISTINCT)
+            ids = set(self.values_list('pk', flat=True))
+            with transaction.atomic():
+                reservations = list(
+                    StockReservation.objects.filter(pk__in=ids, confirmed=False).select_for_update().order_by('product_id', 'product_variation_id', 'pk')
+                )
+                for reservation in reservations:
+                    stock_model, pk = reservation.get_stock_model_and_pk()
+                    stock_model.objects.filter(pk=pk).update(stock=models.F('stock') + reservation.quantity)
+                StockReservation.objects.filter(pk__in=[reservation.pk for reservation in reservations]).delete()
+            return len(reservations)
+
+    class StockReservation(models.Model):
+        cart = models.ForeignKey('Cart', verbose_name=_('cart'), on_delete=models.CASCADE)
+        product = models.ForeignKey(Product, verbose_name=_('product'), on_delete=models.CASCADE)
+        product_variation = models.ForeignKey(ProductVariation, verbose_name=_('product variation'), blank=True, null=True, on_delete=models.CASCADE)
+        quantity = models.PositiveIntegerField(_('quantity'))
+        date_added = models.DateTimeField(_('date added'), auto_now_add=True)
+        confirmed = models.BooleanField(_('confirmed'), default=False)
+
+        objects = StockReservationQuerySet.as_manager()
+
+        class Meta:
+            verbose_name = _('stock reservation')
+            verbose_name_plural = _('stock reservations')
+
+        def __str__(self):
+            return u"%s x %s" % (self.product_id, self.quantity)
+
+        def get_stock_model_and_pk(self):
+            if self.product_variation_id:
+                return ProductVariation, self.product_variation_id
+            return Product, self.product_id
+
+
 class Order(import_item(qshop_settings.CART_ORDER_CLASS) if qshop_settings.CART_ORDER_CLASS else OrderAbstractDefault):
     pass
 
@@ -642,3 +823,15 @@ class Item(import_item(qshop_settings.ITEM_CLASS) if qshop_settings.ITEM_CLASS e
 
 class Cart(import_item(qshop_settings.CART_MODEL_CLASS) if qshop_settings.CART_MODEL_CLASS else CartAbstract):
     pass
+
+
+@receiver(post_save, sender=Item, dispatch_uid='qshop_cart_item_save')
+@receiver(post_delete, sender=Item, dispatch_uid='qshop_cart_item_delete')
+def update_cart_summary(sender, instance, raw=False, **kwargs):
+    if raw or instance.cart_id in suspended_summary_carts.get():
+        return
+    try:
+        cart = instance.cart
+    except Cart.DoesNotExist:
+        return
+    cart.update_summary()
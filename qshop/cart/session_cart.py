@@ -0,0 +1,201 @@
+from decimal import Decimal
+
+from . import models
+from ..models import Product, ProductVariation
+from .cart import CART_ID, CART_SESSION_ITEMS, CartAbstract, ItemTooMany
+
+
+class SessionCartAbstract(CartAbstract):
+    """
+    Cart keeping items in session until the order is made.
+
+    Items are stored as [line id, product id, variation id, quantity, unit price]
+    lists in request.session (use signed cookies session engine to keep them
+    in cookie), Cart and Item rows are created only by create_cart(), which is
+    called when order is saved or promo code is applied.
+
+    QSHOP_CART_CLASS = 'qshop.cart.session_cart.SessionCartAbstract'
+    """
+
+    def __init__(self, request, cart=None):
+        if cart or request.session.get(CART_ID):
+            return super().__init__(request, cart)
+        self._request = request
+        self.cart = self.new(request)
+
+    def is_stored(self):
+        return bool(self.cart.id)
+
+    def get_lines(self):
+        return self._request.session.get(CART_SESSION_ITEMS, [])
+
+    def set_lines(self, lines):
+        if lines:
+            self._request.session[CART_SESSION_ITEMS] = lines
+        elif CART_SESSION_ITEMS in self._request.session:
+            del self._request.session[CART_SESSION_ITEMS]
+        self.clear_cache()
+
+    def get_products(self):
+        if self.is_stored():
+            return super().get_products()
+        try:
+            return self._products
+        except AttributeError:
+            pass
+
+        lines = self.get_lines()
+        products = Product.objects.in_bulk([line[1] for line in lines])
+        variations = ProductVariation.objects.select_related('variation').in_bulk([line[2] for line in lines if line[2]])
+
+        items = []
+        changed = False
+        for line in lines:
+            line_id, product_id, variation_id, quantity, unit_price = line
+            product = products.get(product_id)
+            variation = variations.get(variation_id) if variation_id else None
+            if not product or (variation_id and not variation):
+                changed = True
+                continue
+            item = models.Item(cart=self.cart, quantity=quantity, unit_price=Decimal(unit_price))
+            item.pk = line_id
+            item._real_product = product
+            item._real_product_variation = variation
+            price = str(Decimal(str(item.get_product().get_price(default_currency=True))).quantize(Decimal('0.01')))
+            if price != unit_price:
+                item.unit_price = Decimal(price)
+                line[4] = price
+                changed = True
+            items.append(item)
+
+        if changed:
+            self._request.session[CART_SESSION_ITEMS] = [line for line in lines if line[0] in {item.pk for item in items}]
+        self._products = items
+        return self._products
+
+    def total_products(self):
+        if self.is_stored():
+            return super().total_products()
+        return len(self.get_products())
+
+    def get_discount(self):
+        if self.is_stored():
+            return super().get_discount()
+        return self.cart.discount
+
+    def create_cart(self):
+        if self.is_stored():
+            return
+        items = self.get_products()
+        self._stored_lines = self.get_lines()
+        super().create_cart()
+        for item in items:
+            item.pk = None
+            item.cart = self.cart
+        models.Item.objects.bulk_create(items)
+        self.cart.update_summary()
+        self.set_lines([])
+
+    def add(self, product, quantity=1):
+        if self.is_stored():
+            return super().add(product, quantity)
+        if int(quantity) <= 0:
+            return False
+
+        variation_id = product.selected_variation.pk if product.selected_variation else None
+        lines = self.get_lines()
+        for line in lines:
+            if line[1] == product.pk and line[2] == variation_id:
+                break
+        else:
+            line = [max([line[0] for line in lines] or [0]) + 1, product.pk, variation_id, 0, str(product.get_price(default_currency=True))]
+            lines.append(line)
+
+        if not product.can_be_purchased(line[3] + int(quantity)):
+            e = ItemTooMany('Lack in stock!')
+            e.product = product
+            raise e
+        line[3] += int(quantity)
+        self.set_lines(lines)
+        return True
+
+    def add_many(self, lines, not_found=None):
+        if self.is_stored():
+            return super().add_many(lines, not_found)
+        failed = []
+        for product, quantity in self.iter_lines(lines, failed, not_found):
+            try:
+                self.add(product, quantity)
+            except ItemTooMany:
+                failed.append(product)
+        return failed
+
+    def remove(self, item_id):
+        if self.is_stored():
+            return super().remove(item_id)
+        self.set_lines([line for line in self.get_lines() if str(line[0]) != str(item_id)])
+
+    def update(self, item_id, quantity):
+        if self.is_stored():
+            return super().update(item_id, quantity)
+        if quantity <= 0:
+            return self.remove(item_id)
+
+        for item in self.get_products():
+            if str(item.pk) == str(item_id):
+                if not item.product.can_be_purchased(int(quantity)):
+                    e = ItemTooMany('Lack in stock!')
+                    e.product = item.product
+                    raise e
+                lines = self.get_lines()
+                for line in lines:
+                    if line[0] == item.pk:
+                        line[3] = int(quantity)
+                self.set_lines(lines)
+                return
+
+    def update_many(self, quantities):
+        if self.is_stored():
+            return super().update_many(quantities)
+        failed = []
+        for item_id, quantity in quantities.items():
+            try:
+                self.update(item_id, quantity)
+            except ItemTooMany as e:
+                failed.append(e.product)
+        return failed
+
+    def clear(self):
+        if self.is_stored():
+            return super().clear()
+        self.set_lines([])
+
+    def set_discount(self, discount, reason=""):
+        if self.is_stored():
+            return super().set_discount(discount, reason)
+        self.cart.discount = discount
+        self.cart.discount_reason = reason
+
+    def set_vat_reduction(self, percents):
+        if self.is_stored():
+            return super().set_vat_reduction(percents)
+        self.cart.vat_reduction = percents
+
+    def reserve_stock(self):
+        try:
+            super().reserve_stock()
+        except ItemTooMany:
+            # stored cart is rolled back together with the order, keep items in session
+            if getattr(self, '_stored_lines', None):
+                del self._request.session[CART_ID]
+                self.cart = self.new(self._request)
+                self.set_lines(self._stored_lines)
+            raise
+
+    def checkout(self):
+        self.create_cart()
+        super().checkout()
+
+    def set_promo_code(self, promo_code):
+        self.create_cart()
+        super().set_promo_code(promo_code)
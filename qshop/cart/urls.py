@@ -2,7 +2,7 @@ from django.urls import path
 
 from qshop.qshop_settings import CART_ORDER_VIEW, ENABLE_QSHOP_DELIVERY, ENABLE_PROMO_CODES
 
-from .views import (OrderDetailView, AjaxOrderDetailView, CartDetailView, add_to_cart, cart_order_cancelled,
+from .views import (OrderDetailView, AjaxOrderDetailView, CartDetailView, add_to_cart, add_many_to_cart, cart_json, cart_order_cancelled,
                     cart_order_error, cart_order_success, remove_from_cart, update_cart)
 
 if CART_ORDER_VIEW:
@@ -16,6 +16,8 @@ if ENABLE_PROMO_CODES:
 urlpatterns = [
     path('', CartDetailView.as_view(), name='cart'),
     path('add/<product_id>/', add_to_cart, name='add_to_cart'),
+    path('add-many/', add_many_to_cart, name='add_many_to_cart'),
+    path('json/', cart_json, name='cart_json'),
     path('remove/<item_id>/', remove_from_cart, name='remove_from_cart'),
     path('update/', update_cart, name='update_cart'),
 
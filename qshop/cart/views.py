@@ -1,29 +1,41 @@
+import json
 import re
 
 from django.contrib import messages
+from django.db import transaction
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.views.generic import CreateView, FormView, TemplateView
 
 from qshop import qshop_settings
-from qshop.qshop_settings import CART_CLASS, CART_ORDER_VIEW, REDIRECT_CLASS
+from qshop.qshop_settings import CART_ORDER_VIEW, REDIRECT_CLASS
 
 from ..models import Product
-from .cart import ItemTooMany
+from .cart import ItemTooMany, get_cart
 from .forms import OrderForm
 from .models import Order
 
-if CART_CLASS:
-    from sitemenu import import_item
-    Cart = import_item(CART_CLASS)
-else:
-    from .cart import Cart
+
+def wants_json(request):
+    return 'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+
+def cart_json_response(request, cart, **kwargs):
+    """
+    Cart summary with messages added while handling request.
+    """
+    data = cart.as_dict()
+    data['messages'] = [{'level': message.tags, 'message': str(message)} for message in messages.get_messages(request)]
+    data.update(kwargs)
+    return JsonResponse(data)
 
 
 def add_to_cart(request, product_id):
-    cart = Cart(request)
+    cart = get_cart(request)
 
     quantity = request.GET.get('quantity', 1)
     variation_id = request.GET.get('variation', None)
@@ -55,15 +67,14 @@ def add_to_cart(request, product_id):
                     request, messages.WARNING, _(u'Can\'t add product "%s" due to lack in stock. Try to decrease quantity.') % e.product
                 )
         else:
-            for k, v in variation_quantities.items():
-                product.select_variation(k)
-                try:
-                    if cart.add(product, v):
-                        result = True
-                except ItemTooMany as e:
-                    messages.add_message(
-                        request, messages.WARNING, _(u'Can\'t add product "%s" due to lack in stock. Try to decrease quantity.') % e.product
-                    )
+            lines = [(product, k, v) for k, v in variation_quantities.items() if v > 0]
+            failed = cart.add_many(lines)
+            for failed_product in failed:
+                messages.add_message(
+                    request, messages.WARNING, _(u'Can\'t add product "%s" due to lack in stock. Try to decrease quantity.') % failed_product
+                )
+            if len(failed) < len(lines):
+                result = True
 
         if result:
             messages.add_message(request, messages.INFO, _(u'Product added to <a href="%s">cart</a>.') % reverse('cart'))
@@ -71,38 +82,68 @@ def add_to_cart(request, product_id):
     return_url = request.GET.get('return_url', None)
 
     request._server_cache = {'set_cookie': True}
+    if wants_json(request):
+        return cart_json_response(request, cart)
     if return_url:
         return REDIRECT_CLASS(return_url)
     return REDIRECT_CLASS(reverse('cart'))
 
 
+@require_POST
+def add_many_to_cart(request):
+    """
+    Adds many products at once, expects JSON body:
+    {"items": [{"product": <id>, "variation": <id or null>, "quantity": <int>}, ...]}
+    """
+    try:
+        lines = [
+            (int(line['product']), line.get('variation'), int(line.get('quantity', 1)))
+            for line in json.loads(request.body)['items']
+        ]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Wrong data'}, status=400)
+
+    cart = get_cart(request)
+    not_found = []
+    failed = cart.add_many(lines, not_found)
+
+    request._server_cache = {'set_cookie': True}
+    return cart_json_response(request, cart, failed=[product.pk for product in failed] + not_found)
+
+
+def cart_json(request):
+    return cart_json_response(request, get_cart(request))
+
+
 def remove_from_cart(request, item_id):
-    cart = Cart(request)
+    cart = get_cart(request)
     cart.remove(item_id)
 
     request._server_cache = {'set_cookie': True}
+    if wants_json(request):
+        return cart_json_response(request, cart)
     return REDIRECT_CLASS(reverse('cart'))
 
 
 def update_cart(request):
-    cart = Cart(request)
+    cart = get_cart(request)
+    quantities = {}
     for (key, quantity) in request.POST.items():
         if not key.startswith('quantity.'):
             continue
         try:
-            item_id = int(key.replace('quantity.', ''))
+            quantities[int(key.replace('quantity.', ''))] = int(quantity)
         except:
             continue
 
-        try:
-            quantity = int(quantity)
-            cart.update(item_id, quantity)
-        except ItemTooMany as e:
-            messages.add_message(
-                request, messages.WARNING, _(u'Can\'t add product "%s" due to lack in stock. Try to decrease quantity.') % e.product
-            )
+    for product in cart.update_many(quantities):
+        messages.add_message(
+            request, messages.WARNING, _(u'Can\'t add product "%s" due to lack in stock. Try to decrease quantity.') % product
+        )
 
     request._server_cache = {'set_cookie': True}
+    if wants_json(request):
+        return cart_json_response(request, cart)
     return REDIRECT_CLASS(reverse('cart'))
 
 
@@ -111,7 +152,7 @@ class CartDetailView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['cart'] = Cart(self.request)
+        context['cart'] = get_cart(self.request)
         if qshop_settings.ENABLE_PROMO_CODES:
             context['apply_promo_form'] = ApplyPromoForm()
         return context
@@ -123,8 +164,7 @@ class OrderDetailView(CreateView):
 
     @property
     def cart(self):
-        cart = Cart(self.request)
-        return cart
+        return get_cart(self.request)
 
     def dispatch(self, request, *args, **kwargs):
         if self.cart.total_products() < 1:
@@ -144,8 +184,7 @@ class OrderDetailView(CreateView):
             return order.get_redirect_response()
         except ItemTooMany:
             messages.add_message(self.request, messages.WARNING, _('Someone already bought product that you are trying to buy.'))
-
-        return super(OrderDetailView, self).form_valid(form)
+            return REDIRECT_CLASS(reverse('cart'))
 
 
 class AjaxOrderDetailView(OrderDetailView):
@@ -184,6 +223,8 @@ def cart_order_cancelled(request, order_id=None):
         order.status = 4
         order.add_log_message('Order canceled!')
         order.save()
+        if qshop_settings.STOCK_RESERVATION_ENABLED:
+            order.cart.stockreservation_set.filter(confirmed=False).release()
     return render(request, 'qshop/cart/order_cancelled.html', {
     })
 
@@ -202,7 +243,7 @@ def order_cart(request):
     if CART_ORDER_VIEW:
         return qshop_order_view(request)
 
-    cart = Cart(request)
+    cart = get_cart(request)
 
     order_form = OrderForm()
 
@@ -211,9 +252,10 @@ def order_cart(request):
 
         if order_form.is_valid():
             try:
-                order = order_form.save(cart)
+                with transaction.atomic():
+                    order = order_form.save(cart)
+                    cart.checkout()
                 request.session['order_pk'] = order.pk
-                cart.checkout()
                 order.finish_order(request)
                 return order.get_redirect_response()
             except ItemTooMany:
@@ -241,13 +283,13 @@ if qshop_settings.ENABLE_PROMO_CODES:
 
         def get_context_data(self, **kwargs):
             kwargs = super(ApplyPromoView, self).get_context_data(**kwargs)
-            kwargs['cart'] = Cart(self.request)
+            kwargs['cart'] = get_cart(self.request)
             kwargs['apply_promo_form'] = kwargs['form']
             return kwargs
 
         def get_form_kwargs(self):
             kwargs = super(ApplyPromoView, self).get_form_kwargs()
-            kwargs['cart'] = Cart(self.request)
+            kwargs['cart'] = get_cart(self.request)
             return kwargs
 
         def form_valid(self, form):
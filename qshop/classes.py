@@ -1,26 +1,39 @@
+import hashlib
 import re
 
 from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db.models import Count, Q
+from django.db.models import Q
 from django.http import Http404
+from django.utils.translation import get_language
 from django.utils.translation import gettext_lazy as _
 
+from .cache import category_cache_key, get_cache, page_cache_key
+from .facets import FacetIndex
+from .paginator import CachedCountPaginator, KeysetPaginator
 from .models import (
     ParametersSet,
-    ParameterValue,
+    Currency,
     Product,
     ProductToParameter,
     ProductVariationValue,
 )
 from .qshop_settings import (
     FILTER_BY_VARIATION_TYPE,
+    FILTERS_CACHE_ENABLED,
+    FILTERS_CACHE_TIMEOUT,
     FILTERS_ENABLED,
+    FILTERS_ENGINE,
     FILTERS_FIELDS,
     FILTERS_NEED_COUNT,
     FILTERS_ORDER,
     FILTERS_PRECLUDING,
+    PAGINATION_COUNT_CACHE_ENABLED,
+    PAGINATION_COUNT_CACHE_TIMEOUT,
+    PAGINATION_TYPE,
     PRODUCTS_ON_PAGE,
+    PRODUCTS_PREFETCH_PAGE_DATA,
     REDIRECT_CLASS,
     VARIATION_FILTER_NAME,
 )
@@ -67,13 +80,16 @@ class CategoryData:
             self.return_data = REDIRECT_CLASS(self.link_for_page(skip_page=False))
             self.need_return = True
 
-    def filter_products(self, exclude_filter_id=None):
+    def get_base_products(self):
         if self.init_products is not None:
-            products = self.init_products
+            return self.init_products
         elif not self.menu.page_type == 'pdis':
-            products = Product.in_category_objects.filter(category=self.menu)
+            return Product.in_category_objects.filter(category=self.menu)
         else:
-            products = Product.in_category_objects.exclude(discount_price=None)
+            return Product.in_category_objects.exclude(discount_price=None)
+
+    def filter_products(self, exclude_filter_id=None):
+        products = self.get_base_products()
 
         for filter_q in self.get_q_filters(exclude_filter_id):
             products = products.filter(filter_q)
@@ -81,125 +97,239 @@ class CategoryData:
         return products
 
 
+    def get_ordering(self):
+        sort = self.sort[1]
+        if sort == 'price' or sort == '-price':
+            return [sort.replace('price', 'min_price'), 'id']
+        if isinstance(sort, str):
+            return [sort, 'id']
+        return list(sort)
+
+    def sort_products(self, products):
+        return products.order_by(*self.get_ordering())
+
+    def can_use_keyset_pagination(self):
+        ordering = self.get_ordering()
+        for field in ordering:
+            if '__' in field or '?' in field:
+                return False
+            try:
+                if Product._meta.get_field(field.lstrip('-')).null:
+                    return False
+            except FieldDoesNotExist:
+                return False
+        return ordering[-1].lstrip('-') in ('id', 'pk')
+
+    def is_numeric_page(self):
+        try:
+            return int(self.page) > 1
+        except (TypeError, ValueError):
+            return False
+
+    def get_count_cache_key(self):
+        """
+        Returns cache key for total count of products shown with current
+        filters or None if count can't be cached. Count does not depend on
+        sorting, so all sortings of the same filtered list share it.
+        """
+        if not PAGINATION_COUNT_CACHE_ENABLED or self.init_products is not None or self.menu.page_type == 'pdis':
+            return None
+        selected_filters = {filter_id: value_ids for filter_id, filter_type, value_ids in sorted(self.get_selected_filters())}
+        return category_cache_key('count', self.menu.pk, self.encode_filters(selected_filters), get_language())
+
     def process_products(self):
         products = self.filter_products()
 
         if FILTERS_PRECLUDING:
             self.set_aviable_filters(products)
 
-        if self.sort[1] == 'price' or self.sort[1] == '-price':
-            sort = self.sort[1].replace('price', 'min_price')
-            products = products.extra(select={'min_price': "IF(`qshop_product`.`discount_price`, `qshop_product`.`discount_price`, `qshop_product`.`price`)"}).order_by(sort)
+        if self.use_bitmap_engine():
+            paginator = Paginator(self.get_filtered_product_ids(), PRODUCTS_ON_PAGE)
+        elif PAGINATION_TYPE == 'keyset' and self.can_use_keyset_pagination():
+            if self.is_numeric_page():
+                # numeric pages would need OFFSET, old links are redirected to the first page
+                self.page = 1
+            products = products.distinct()
+            paginator = KeysetPaginator(products, PRODUCTS_ON_PAGE, self.get_ordering(), self.get_count_cache_key(), PAGINATION_COUNT_CACHE_TIMEOUT)
         else:
-            sort = self.sort[1]
-            if isinstance(sort, str):
-                sort = (sort, 'id')
-            products = products.order_by(*sort)
+            paginator = CachedCountPaginator(self.sort_products(products).distinct(), PRODUCTS_ON_PAGE, self.get_count_cache_key(), PAGINATION_COUNT_CACHE_TIMEOUT)
 
-        products = products.distinct()
-
-        paginator = Paginator(products, PRODUCTS_ON_PAGE)
         try:
             products_page = paginator.page(self.page)
         except (PageNotAnInteger, EmptyPage):
             raise Http404('There is no such page')
 
+        if self.use_bitmap_engine():
+            products = self.get_base_products().in_bulk(products_page.object_list)
+            products_page.object_list = [products[product_id] for product_id in products_page.object_list if product_id in products]
+
         if not self.menu.page_type == 'pdis':
             for product in products_page.object_list:
                 product._current_category = self.menu
 
+        if PRODUCTS_PREFETCH_PAGE_DATA:
+            Product.prefetch_page_data(products_page.object_list)
+
+        Currency.convert_prices(products_page.object_list)
+
         self.products_page = products_page
 
+    def use_bitmap_engine(self):
+        """
+        Bitmap engine is used for category listings only and only with
+        filters cache (without it index and sorted ids would be loaded on
+        every request), otherwise products are paginated with queryset.
+        """
+        return FILTERS_ENGINE == 'bitmap' and self._can_use_cache()
+
+    def _can_use_cache(self):
+        return FILTERS_CACHE_ENABLED and self.init_products is None and not self.menu.page_type == 'pdis'
+
+    def get_sorted_product_ids(self):
+        """
+        Returns ids of all not filtered products in current sorting.
+        """
+        if self._can_use_cache():
+            cache = get_cache()
+            cache_key = category_cache_key('sorting', self.menu.pk, self.sort[0])
+            product_ids = cache.get(cache_key)
+            if product_ids is not None:
+                return product_ids
+
+        product_ids = []
+        seen = set()
+        for product_id in self.sort_products(self.get_base_products()).values_list('pk', flat=True):
+            if product_id not in seen:
+                seen.add(product_id)
+                product_ids.append(product_id)
+
+        if self._can_use_cache():
+            cache.set(cache_key, product_ids, FILTERS_CACHE_TIMEOUT)
+        return product_ids
+
+    def get_filtered_product_ids(self):
+        """
+        Resolves selected filters with facet index bitsets and returns ids of
+        matching products in current sorting without joins and DISTINCT.
+        """
+        index = self.get_facet_index()
+        matched_ids = set(index.get_product_ids(index.match(self.get_selected_filters())))
+        return [product_id for product_id in self.get_sorted_product_ids() if product_id in matched_ids]
+
     def _get_filters_data(self):
         filters = {}
         filters_order = []
 
         if FILTERS_ENABLED:
-
-            parameter_name = 'parameter__name'
-            value_value = 'value__value'
-
-            if apps.is_installed('modeltranslation'):
-                from django.utils.translation import get_language
-                parameter_name = 'parameter__name_%s' % get_language()
-                value_value = 'value__value_%s' % get_language()
-
-
-            for filter_key in FILTERS_ORDER:
-                if filter_key == 'p':
-                    filters_qs = ProductToParameter.objects.values(
-                        'parameter__id',
-                        parameter_name,
-                        'value__id',
-                        value_value
-                    ).filter(
-                        product__category=self.menu,
-                        product__hidden=False,
-                        parameter__is_filter=True
-                    ).exclude(
-                        value=None
-                    ).order_by(
-                        'parameter__parameters_set',
-                        'parameter__order',
-                        value_value
+            if FILTERS_CACHE_ENABLED:
+                cache = get_cache()
+                cache_key = category_cache_key('filters', self.menu.pk, get_language())
+                filters_data = cache.get(cache_key)
+                if filters_data is None:
+                    filters_data = self._build_filters_data()
+                    cache.set(cache_key, filters_data, FILTERS_CACHE_TIMEOUT)
+            else:
+                filters_data = self._build_filters_data()
+
+            for filter_key, filter_id, filter_name, filter_type, values in filters_data:
+                if filter_key == 'v':
+                    filter_aviability_check = self._check_variation_filter
+                    get_q = lambda value_id: Q(productvariation__variation_id=value_id)
+                elif filter_key == 'p':
+                    filter_aviability_check = self._check_parameter_filter
+                    get_q = lambda value_id: Q(producttoparameter__value_id=value_id)
+                else:
+                    filter_aviability_check = self._check_foreignkey_filter
+                    get_q = lambda value_id, field_name=FILTERS_FIELDS[filter_id]: Q(**{'{0}_id'.format(field_name): value_id})
+
+                filters_order.append(filter_id)
+                filters[filter_id] = {'name': filter_name, 'has_active': False, 'values': [], 'filter_type': filter_type, 'filter_key': filter_key, 'filter_aviability_check': filter_aviability_check}
+                for value_id, value_name in values:
+                    filters[filter_id]['values'].append(
+                        (value_id, {'name': value_name, 'active': False, 'unaviable': False, 'count': 0, 'filter': get_q(value_id)})
                     )
 
-                    filters_qs.query.group_by = ['value__id']
-
-                    for item in filters_qs:
-                        filter_id = "p{0}".format(item['parameter__id'])
-                        if not filter_id in filters:
-                            filters_order.append(filter_id)
-                            filters[filter_id] = {'name': item[parameter_name], 'has_active': False, 'values': [], 'filter_type': 'or', 'filter_aviability_check': self._check_parameter_filter}
-                        filters[filter_id]['values'].append(
-                            (item['value__id'], {'name': item[value_value], 'active': False, 'unaviable': False, 'count': 0, 'filter': Q(producttoparameter__value_id=item['value__id'])})
-                        )
-                elif filter_key == 'v':
-                    variations = ProductVariationValue.objects.filter(productvariation__product__category=self.menu, productvariation__product__hidden=False).distinct().order_by('value')
-                    if variations:
-                        filters_order.append('v')
-
-                        if hasattr(self.menu, 'get_variation_name'):
-                            variation_name = self.menu.get_variation_name()
-                        elif hasattr(ParametersSet, 'get_variation_name'):
-                            try:
-                                variation_name = ParametersSet.objects.filter(product__category=self.menu)[0].get_variation_name()
-                            except:
-                                variation_name = _(VARIATION_FILTER_NAME)
-                        else:
+        return filters, filters_order
+
+    def _build_filters_data(self):
+        """
+        Returns filters of current category as plain picklable list of
+        (filter_key, filter_id, name, filter_type, [(value_id, value_name), ...]).
+        filter_key is the FILTERS_ORDER entry the filter was built from.
+        """
+        filters_data = []
+
+        parameter_name = 'parameter__name'
+        value_value = 'value__value'
+
+        if apps.is_installed('modeltranslation'):
+            parameter_name = 'parameter__name_%s' % get_language()
+            value_value = 'value__value_%s' % get_language()
+
+        for filter_key in FILTERS_ORDER:
+            if filter_key == 'p':
+                filters_qs = ProductToParameter.objects.values(
+                    'parameter__id',
+                    parameter_name,
+                    'value__id',
+                    value_value
+                ).filter(
+                    product__category=self.menu,
+                    product__hidden=False,
+                    parameter__is_filter=True
+                ).exclude(
+                    value=None
+                ).order_by(
+                    'parameter__parameters_set',
+                    'parameter__order',
+                    value_value
+                )
+
+                filters_qs.query.group_by = ['value__id']
+
+                parameter_filters = {}
+                for item in filters_qs:
+                    filter_id = "p{0}".format(item['parameter__id'])
+                    if not filter_id in parameter_filters:
+                        parameter_filters[filter_id] = (filter_key, filter_id, item[parameter_name], 'or', [])
+                        filters_data.append(parameter_filters[filter_id])
+                    parameter_filters[filter_id][4].append((item['value__id'], item[value_value]))
+            elif filter_key == 'v':
+                variations = ProductVariationValue.objects.filter(productvariation__product__category=self.menu, productvariation__product__hidden=False).distinct().order_by('value')
+                if variations:
+                    if hasattr(self.menu, 'get_variation_name'):
+                        variation_name = self.menu.get_variation_name()
+                    elif hasattr(ParametersSet, 'get_variation_name'):
+                        try:
+                            variation_name = ParametersSet.objects.filter(product__category=self.menu)[0].get_variation_name()
+                        except:
                             variation_name = _(VARIATION_FILTER_NAME)
+                    else:
+                        variation_name = _(VARIATION_FILTER_NAME)
 
-                        filters['v'] = {'name': variation_name, 'has_active': False, 'values': [], 'filter_type': FILTER_BY_VARIATION_TYPE, 'filter_aviability_check': self._check_variation_filter}
-                        for variation in variations:
-                            filters['v']['values'].append(
-                                (variation.id, {'name': variation.get_filter_name(), 'active': False, 'unaviable': False, 'count': 0, 'filter': Q(productvariation__variation_id=variation.id)})
-                            )
-                else:
-                    field_name = FILTERS_FIELDS[filter_key]
-                    if not hasattr(Product, field_name):
-                        raise Exception('[qShop exception] Filter configuration error: there is no {0} in Product class!'.format(field_name))
-                    field = Product._meta.get_field(field_name)
-                    model = field.related_model
-
-                    items = model.objects.filter(product__category=self.menu, product__hidden=False).distinct()
-
-                    try:
-                        items = items.order_by(field.related_model.get_order_by_in_filter())
-                    except:
-                        pass
-
-                    if items:
-                        filters_order.append(filter_key)
-                        filters[filter_key] = {'name': field.verbose_name, 'has_active': False, 'values': [], 'filter_type': 'or', 'filter_aviability_check': self._check_foreignkey_filter}
-                        for item in items:
-                            q = {
-                                '{0}_id'.format(field_name): item.id
-                            }
-                            filters[filter_key]['values'].append(
-                                (item.id, {'name': item.__str__(), 'active': False, 'unaviable': False, 'count': 0, 'filter': Q(**q)})
-                            )
+                    filters_data.append((filter_key, 'v', str(variation_name), FILTER_BY_VARIATION_TYPE, [
+                        (variation.id, variation.get_filter_name()) for variation in variations
+                    ]))
+            else:
+                field_name = FILTERS_FIELDS[filter_key]
+                if not hasattr(Product, field_name):
+                    raise Exception('[qShop exception] Filter configuration error: there is no {0} in Product class!'.format(field_name))
+                field = Product._meta.get_field(field_name)
+                model = field.related_model
 
-        return filters, filters_order
+                items = model.objects.filter(product__category=self.menu, product__hidden=False).distinct()
+
+                try:
+                    items = items.order_by(field.related_model.get_order_by_in_filter())
+                except:
+                    pass
+
+                if items:
+                    filters_data.append((filter_key, filter_key, str(field.verbose_name), 'or', [
+                        (item.id, item.__str__()) for item in items
+                    ]))
+
+        return filters_data
 
     def process_filters(self):
         filters, filters_order = self._get_filters_data()
@@ -316,7 +446,7 @@ class CategoryData:
             string += 'sort-%s/' % sorting
         if self.filter_string:
             string += 'filter-%s/' % self.filter_string
-        if not skip_page and int(self.page) != 1:
+        if not skip_page and str(self.page) != '1':
             string += 'page-%s/' % self.page
 
         return self.menu.get_absolute_url() + string
@@ -337,74 +467,63 @@ class CategoryData:
     def get_sorting_variants_as_list(self):
         return list(self.get_sorting_variants())
 
+    def get_fragment_cache_key(self, name):
+        """
+        Returns cache key of named part of products page (used by qshop_cache
+        template tag) or None if page can't be cached.
+        """
+        if self.init_products is not None or self.menu.page_type == 'pdis':
+            return None
+        path_hash = hashlib.md5(self.link_for_page(skip_page=False).encode('utf-8')).hexdigest()
+        return page_cache_key('fragment', self.menu.pk, name, Currency.get_default_currency().code, get_language(), path_hash)
+
     def get_filters(self):
         for item in self.filters_order:
             yield (item, self.filters[item])
 
-    def _check_parameter_filter(self, filter_id, filter_data, products):
-        products = self.filter_products(filter_id)
-        if FILTERS_NEED_COUNT:
-            aviable_parameters_data = ParameterValue.objects.filter(producttoparameter__product__in=products).annotate(total_items=Count('id')).values_list('id', 'total_items')
-            aviable_parameters = []
-            parameters_counts = {}
-            for aviable_parameter, parameter_count in aviable_parameters_data:
-                aviable_parameters.append(aviable_parameter)
-                parameters_counts[aviable_parameter] = parameter_count
-        else:
-            aviable_parameters = ProductToParameter.objects.filter(product__in=products).distinct().values_list('value_id', flat=True)
-            parameters_counts = {}
-
+    def get_facet_index(self):
+        try:
+            return self._facet_index
+        except AttributeError:
+            pass
+
+        if self._can_use_cache():
+            cache = get_cache()
+            cache_key = category_cache_key('facets', self.menu.pk)
+            self._facet_index = cache.get(cache_key)
+            if self._facet_index is not None:
+                return self._facet_index
+
+        filter_keys = {filter_id: filter_data['filter_key'] for filter_id, filter_data in self.filters.items()}
+        self._facet_index = FacetIndex.build(self.get_base_products(), filter_keys)
+
+        if self._can_use_cache():
+            cache.set(cache_key, self._facet_index, FILTERS_CACHE_TIMEOUT)
+        return self._facet_index
+
+    def get_selected_filters(self):
+        selected = []
+        for filter_id, filter_data in self.filters.items():
+            value_ids = [value_id for value_id, value_data in filter_data['values'] if value_data['active']]
+            if value_ids:
+                selected.append((filter_id, filter_data['filter_type'], value_ids))
+        return selected
+
+    def _check_filter(self, filter_id, filter_data):
+        counts = self.get_facet_index().counts(filter_id, self.get_selected_filters())
 
         for value_id, value_data in filter_data['values']:
-            if FILTERS_NEED_COUNT and value_id in parameters_counts:
-                value_data['count'] = parameters_counts[value_id]
-            if value_id not in aviable_parameters:
+            count = counts.get(value_id, 0)
+            if FILTERS_NEED_COUNT:
+                value_data['count'] = count
+            if not count:
                 value_data['unaviable'] = True
 
-
+    def _check_parameter_filter(self, filter_id, filter_data, products):
+        self._check_filter(filter_id, filter_data)
 
     def _check_variation_filter(self, filter_id, filter_data, products):
-        products = self.filter_products(filter_id)
-
-        if FILTERS_NEED_COUNT:
-            aviable_variations_data = ProductVariationValue.objects.filter(productvariation__product__in=products).annotate(total_items=Count('id')).values_list('id', 'total_items')
-            aviable_variations = []
-            variations_counts = {}
-            for aviable_parameter, parameter_count in aviable_variations_data:
-                aviable_variations.append(aviable_parameter)
-                variations_counts[aviable_parameter] = parameter_count
-        else:
-            aviable_variations = ProductVariationValue.objects.filter(productvariation__product__in=products).distinct().values_list('id', flat=True)
-            variations_counts = {}
-
-        for value_id, value_data in filter_data['values']:
-            if FILTERS_NEED_COUNT and value_id in variations_counts:
-                value_data['count'] = variations_counts[value_id]
-            if value_id not in aviable_variations:
-                value_data['unaviable'] = True
+        self._check_filter(filter_id, filter_data)
 
     def _check_foreignkey_filter(self, filter_id, filter_data, products):
-        products = self.filter_products(filter_id)
-
-        field_name = FILTERS_FIELDS[filter_id]
-        field = Product._meta.get_field(field_name)
-        model = field.related_model
-
-        model.objects.filter(product__category=self.menu).distinct()
-
-        if FILTERS_NEED_COUNT:
-            aviable_field_data = model.objects.filter(product__in=products).annotate(total_items=Count('id')).values_list('id', 'total_items')
-            aviable_field = []
-            field_counts = {}
-            for item, count in aviable_field_data:
-                aviable_field.append(item)
-                field_counts[item] = count
-        else:
-            aviable_field = model.objects.filter(product__in=products).distinct().values_list('id', flat=True)
-            field_counts = {}
-
-        for value_id, value_data in filter_data['values']:
-            if FILTERS_NEED_COUNT and value_id in field_counts:
-                value_data['count'] = field_counts[value_id]
-            if value_id not in aviable_field:
-                value_data['unaviable'] = True
+        self._check_filter(filter_id, filter_data)
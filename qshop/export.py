@@ -0,0 +1,156 @@
+"""
+Streaming export of products catalogue. Products are loaded in id ordered
+chunks, every format is a generator of strings, so memory use doesn't grow
+with catalogue size (use with StreamingHttpResponse or write to file).
+"""
+import csv
+import json
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+
+from .models import Currency, Product
+from .qshop_settings import STOCK_RESERVATION_ENABLED
+
+
+def iter_products(queryset=None, chunk_size=500):
+    """
+    Yields products (not hidden by default) in id order, loading chunk_size
+    of them at once with variations, images, parameters and urls.
+    """
+    if queryset is None:
+        queryset = Product.objects.filter(hidden=False)
+    last_pk = 0
+    while True:
+        products = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not products:
+            break
+        Product.prefetch_page_data(products)
+        Product.prefetch_absolute_urls(products)
+        for product in products:
+            yield product
+        last_pk = products[-1].pk
+
+
+def get_prices(product, currencies):
+    """
+    Returns ({code: price}, {code: discount price}) converted with
+    Currency.get_price, as prices are shown on site in every currency.
+    """
+    prices = {}
+    discount_prices = {}
+    for currency in currencies:
+        token = Currency.set_default_currency(currency)
+        try:
+            price = product.get_price_real()
+            discount_price = product.get_price_discount()
+        finally:
+            Currency.reset_default_currency(token)
+        prices[currency.code] = Decimal('%.2f' % price)
+        discount_prices[currency.code] = Decimal('%.2f' % discount_price) if discount_price is not None else None
+    return prices, discount_prices
+
+
+def iter_rows(products):
+    """
+    Yields dict for every product, or for every variation of product with
+    variations, with prices in all currencies.
+    """
+    currencies = list(Currency.get_currencies().values())
+    for product in products:
+        parameters = {parameter['name']: parameter['value'] for parameter in product.get_parameters()}
+        variations = list(product.get_variations()) if product.has_variations else []
+        for variation in variations or [None]:
+            product.selected_variation = variation
+            prices, discount_prices = get_prices(product, currencies)
+            row = {
+                'id': product.articul if variation is None else '%s-%s' % (product.articul, variation.pk),
+                'product_id': product.pk,
+                'articul': product.articul,
+                'variation': variation.name if variation else '',
+                'name': product.name,
+                'description': product.description,
+                'url': settings.SITE_URL + product.absolute_url,
+                'image': settings.SITE_URL + product.image.url if product.image else '',
+                'weight': product.weight,
+                'parameters': parameters,
+                'prices': prices,
+                'discount_prices': discount_prices,
+            }
+            if STOCK_RESERVATION_ENABLED:
+                row['stock'] = product.get_stock_object().stock
+            yield row
+        product.selected_variation = None
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def export_csv(rows):
+    writer = csv.writer(Echo())
+    currency_codes = list(Currency.get_currencies().keys())
+    columns = ['id', 'product_id', 'articul', 'variation', 'name', 'url', 'image', 'weight']
+    if STOCK_RESERVATION_ENABLED:
+        columns.append('stock')
+    yield writer.writerow(
+        columns + ['price_%s' % code for code in currency_codes] + ['discount_price_%s' % code for code in currency_codes] + ['parameters']
+    )
+    for row in rows:
+        yield writer.writerow(
+            [row[column] for column in columns] +
+            [row['prices'][code] for code in currency_codes] +
+            [row['discount_prices'][code] for code in currency_codes] +
+            [json.dumps(row['parameters'], ensure_ascii=False)]
+        )
+
+
+def export_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, default=str, ensure_ascii=False) + '\n'
+
+
+def export_merchant_xml(rows, currency=None):
+    """
+    Google Merchant (RSS 2.0) feed with prices in given or default currency.
+    """
+    currency = currency or Currency.get_default_currency_notoverloadable()
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield '<rss version="2.0" xmlns:g="http://base.google.com/ns/1.0">\n<channel>\n'
+    yield '<title>%s</title>\n<link>%s</link>\n' % (escape(settings.SITE_URL), escape(settings.SITE_URL))
+    for row in rows:
+        price = row['prices'][currency.code]
+        discount_price = row['discount_prices'][currency.code]
+        availability = 'in stock' if row.get('stock', 1) > 0 else 'out of stock'
+        item = [
+            ('g:id', row['id']),
+            ('title', '%s %s' % (row['name'], row['variation']) if row['variation'] else row['name']),
+            ('description', row['description']),
+            ('link', row['url']),
+            ('g:image_link', row['image']),
+            ('g:price', '%s %s' % (price, currency.code)),
+            ('g:availability', availability),
+        ]
+        if discount_price:
+            item.append(('g:sale_price', '%s %s' % (discount_price, currency.code)))
+        if row['variation']:
+            item.append(('g:item_group_id', row['articul']))
+        yield '<item>%s</item>\n' % ''.join(
+            '<{0}>{1}</{0}>'.format(tag, escape(str(value))) for tag, value in item if value
+        )
+    yield '</channel>\n</rss>\n'
+
+
+# format: (generator, content type)
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (export_jsonl, 'application/x-ndjson; charset=utf-8'),
+    'xml': (export_merchant_xml, 'application/xml; charset=utf-8'),
+}
+
+
+def export_products(export_format, queryset=None, chunk_size=500):
+    export, content_type = EXPORT_FORMATS[export_format]
+    return export(iter_rows(iter_products(queryset, chunk_size)))
@@ -0,0 +1,99 @@
+from .models import ProductToParameter, ProductVariation
+from .qshop_settings import FILTERS_FIELDS
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+
+class FacetIndex:
+    """
+    Filter values of a set of products as bitsets.
+
+    Every product gets a bit position, every filter value keeps an integer
+    with bits of products having that value set. Filtering and counting is
+    then done with bitwise operations instead of database queries.
+    """
+
+    def __init__(self, product_ids, membership):
+        self.product_ids = list(product_ids)
+        self.positions = {product_id: i for i, product_id in enumerate(self.product_ids)}
+        self.all = (1 << len(self.product_ids)) - 1
+        self.values = {}
+        for filter_id, value_id, product_id in membership:
+            try:
+                bit = 1 << self.positions[product_id]
+            except KeyError:
+                continue
+            filter_values = self.values.setdefault(filter_id, {})
+            filter_values[value_id] = filter_values.get(value_id, 0) | bit
+
+    @classmethod
+    def build(cls, products, filter_keys):
+        """
+        products - queryset of all products which can be shown
+        filter_keys - {filter_id: filter_key} where filter_key is FILTERS_ORDER entry
+
+        Runs one query for products (with foreign key filters values), one for
+        parameters and one for variations if such filters exist.
+        """
+        fields = [(filter_id, FILTERS_FIELDS[filter_key]) for filter_id, filter_key in filter_keys.items() if filter_key not in ('p', 'v')]
+        products = products.order_by()
+
+        product_ids = []
+        membership = []
+        for row in products.values_list('pk', *['{0}_id'.format(field_name) for filter_id, field_name in fields]).distinct():
+            product_ids.append(row[0])
+            for (filter_id, field_name), value_id in zip(fields, row[1:]):
+                if value_id is not None:
+                    membership.append((filter_id, value_id, row[0]))
+
+        if 'p' in filter_keys.values():
+            for product_id, parameter_id, value_id in ProductToParameter.objects.filter(
+                product__in=products.values('pk'),
+                parameter__is_filter=True,
+            ).exclude(
+                value=None
+            ).values_list('product_id', 'parameter_id', 'value_id'):
+                membership.append(('p{0}'.format(parameter_id), value_id, product_id))
+
+        if 'v' in filter_keys.values():
+            for product_id, value_id in ProductVariation.objects.filter(
+                product__in=products.values('pk'),
+            ).values_list('product_id', 'variation_id'):
+                membership.append(('v', value_id, product_id))
+
+        return cls(sorted(set(product_ids)), membership)
+
+    def match(self, selected, exclude_filter_id=None):
+        """
+        selected - list of (filter_id, filter_type, [value_id, ...]).
+        Values are joined with OR inside of 'or' filters, everything else with AND.
+        """
+        bits = self.all
+        for filter_id, filter_type, value_ids in selected:
+            if filter_id == exclude_filter_id:
+                continue
+            filter_values = self.values.get(filter_id, {})
+            if filter_type == 'or':
+                filter_bits = 0
+                for value_id in value_ids:
+                    filter_bits |= filter_values.get(value_id, 0)
+                bits &= filter_bits
+            else:
+                for value_id in value_ids:
+                    bits &= filter_values.get(value_id, 0)
+        return bits
+
+    def counts(self, filter_id, selected):
+        """
+        Returns {value_id: products count} for values of filter_id, counted over
+        products matching all selected filters except filter_id itself.
+        """
+        bits = self.match(selected, exclude_filter_id=filter_id)
+        return {value_id: popcount(value_bits & bits) for value_id, value_bits in self.values.get(filter_id, {}).items()}
+
+    def get_product_ids(self, bits):
+        return [self.product_ids[i] for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
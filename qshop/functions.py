@@ -25,7 +25,7 @@ def get_products_page_data(url_add):
         show_product = False
         del url_add[0]
     if url_add and url_add[0].startswith('page-'):
-        page_num = url_add[0].replace('page-', '')
+        page_num = url_add[0][len('page-'):]
         show_product = False
         del url_add[0]
     return (filter_string, page_num, sort, show_product)
@@ -0,0 +1,31 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from qshop.cart.models import Cart
+
+
+# Run from command line (e.g. daily from cron): manage.py qshop_delete_stale_carts --days=30
+class Command(BaseCommand):
+    help = 'Deletes carts which were not checked out and not modified for given number of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', dest='days', type=int, default=30, help='Delete carts not modified for this many days')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000, help='How many carts to delete in one transaction')
+        parser.add_argument('--pause', dest='pause', type=float, default=0.1, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - datetime.timedelta(days=options['days'])
+        started = time.time()
+
+        def report(deleted_carts, deleted_items):
+            if options['verbosity'] > 1:
+                self.stdout.write('Deleted %d carts, %d items' % (deleted_carts, deleted_items))
+
+        deleted_carts, deleted_items = Cart.delete_stale(older_than, options['batch_size'], options['pause'], callback=report)
+        elapsed = time.time() - started
+        self.stdout.write('Deleted %d carts and %d items in %.1fs (%.0f carts/s)' % (
+            deleted_carts, deleted_items, elapsed, deleted_carts / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,28 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from qshop.export import EXPORT_FORMATS, export_products
+
+
+# Run from command line: manage.py qshop_export_products --format=xml --output=feed.xml
+class Command(BaseCommand):
+    help = 'Exports products with variations, parameters, prices and urls to CSV, JSON Lines or merchant feed XML'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='format', choices=sorted(EXPORT_FORMATS.keys()), default='csv', help='Export format')
+        parser.add_argument('--output', dest='output', default=None, help='File to write to (stdout by default)')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=500, help='How many products to load at once')
+
+    def handle(self, *args, **options):
+        chunks = export_products(options['format'], chunk_size=options['chunk_size'])
+        if options['output']:
+            # written to temporary file and moved, so the file served by export view is always complete
+            tmp_path = options['output'] + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+            os.replace(tmp_path, options['output'])
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
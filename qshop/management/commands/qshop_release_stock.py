@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from qshop import qshop_settings
+
+
+# Run from command line (e.g. every few minutes from cron): manage.py qshop_release_stock
+class Command(BaseCommand):
+    help = 'Returns to stock quantities reserved by expired unpaid and canceled orders'
+
+    def handle(self, *args, **options):
+        if not qshop_settings.STOCK_RESERVATION_ENABLED:
+            raise CommandError('QSHOP_STOCK_RESERVATION_ENABLED is off')
+        from qshop.cart.models import StockReservation
+
+        released = StockReservation.objects.expired().release()
+        self.stdout.write('Released %d stock reservations' % released)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from qshop.models import Product
+
+
+# Run from command line: manage.py qshop_update_min_prices
+# (required after upgrade which adds min_price column, until then all products sort as price 0)
+class Command(BaseCommand):
+    help = 'Recalculates stored min price (used for sorting by price) of all products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000, help='How many products to process at once')
+
+    def handle(self, *args, **options):
+        last_id = 0
+        updated = 0
+        while True:
+            products = list(Product.objects.filter(pk__gt=last_id).order_by('pk').prefetch_related('productvariation_set')[:options['chunk_size']])
+            if not products:
+                break
+            for product in products:
+                if product.min_price != product.get_min_price():
+                    product.update_min_price()
+                    updated += 1
+            last_id = products[-1].pk
+        self.stdout.write('Updated min price of %d products' % updated)
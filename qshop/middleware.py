@@ -1,29 +1,44 @@
+from django.utils.deprecation import MiddlewareMixin
+
 from .models import Currency
 from .qshop_settings import REDIRECT_CLASS
 from sitemenu.sitemenu_settings import SERVER_CACHE_DIR
 
 
-class CurrencyMiddleware(object):
+class CurrencyMiddleware(MiddlewareMixin):
+    """
+    Sets currency of current request from ?currency= parameter or session.
+
+    Works in both sync and async middleware stacks. Currencies are taken from
+    in-memory table (no queries) and session is written only when visitor
+    changes currency, visitors with default currency don't get session at all.
+    Currency is reset after response, so it doesn't leak to the next request
+    of the same thread.
+    """
 
     def process_request(self, request):
         get_currency = request.GET.get('currency', None)
-        current_currency = None
         if get_currency:
-            try:
-                current_currency = Currency.objects.get(code=get_currency)
-                request.session['currency'] = get_currency
-                Currency.set_default_currency(current_currency)
+            current_currency = Currency.get_currency_by_code(get_currency)
+            if current_currency:
+                if request.session.get('currency') != current_currency.code:
+                    request.session['currency'] = current_currency.code
+                request._qshop_currency_token = Currency.set_default_currency(current_currency)
                 if SERVER_CACHE_DIR:
                     request._server_cache = {'set_cookie': True}
 
                 return REDIRECT_CLASS(request.path)
-            except:
-                pass
+
+        current_currency = Currency.get_currency_by_code(request.session.get('currency'))
         if not current_currency:
-            try:
-                current_currency = Currency.objects.get(code=request.session['currency'])
-            except:
-                current_currency = Currency.get_default_currency()
-                request.session['currency'] = current_currency.code
+            current_currency = Currency.get_default_currency_notoverloadable()
+
+        request._qshop_currency_token = Currency.set_default_currency(current_currency)
 
-        Currency.current_currency = current_currency
+    def process_response(self, request, response):
+        # don't leave currency of this request to the next one handled by the thread
+        token = getattr(request, '_qshop_currency_token', None)
+        if token is not None:
+            Currency.reset_default_currency(token)
+            del request._qshop_currency_token
+        return response
@@ -1,3 +1,5 @@
+import time
+from contextvars import ContextVar
 from decimal import Decimal
 
 from django.db import models
@@ -13,8 +15,11 @@ from sitemenu import import_item
 from sitemenu.helpers import upload_to_slugify
 from .qshop_settings import (
     PRODUCT_CLASS, VARIATION_CLASS, VARIATION_VALUE_CLASS, PRODUCT_IMAGE_CLASS, PARAMETERS_SET_CLASS,
-    PARAMETER_CLASS, PARAMETER_VALUE_CLASS, PRODUCT_TO_PARAMETER_CLASS, CURRENCY_CLASS, LOAD_ADDITIONAL_MODELS, PROMO_CODE_CLASS
+    PARAMETER_CLASS, PARAMETER_VALUE_CLASS, PRODUCT_TO_PARAMETER_CLASS, CURRENCY_CLASS, LOAD_ADDITIONAL_MODELS, PROMO_CODE_CLASS,
+    CURRENCY_CACHE_TIMEOUT, STOCK_RESERVATION_ENABLED, PRODUCT_URL_CACHE_TIMEOUT, ARTICUL_CACHE_ENABLED,
+    ARTICUL_CACHE_TIMEOUT, ARTICUL_NOT_FOUND_CACHE_TIMEOUT
 )
+from .cache import articul_cache_key, bump_generation, get_cache, product_url_cache_keys
 
 import re
 from django.core.exceptions import ValidationError
@@ -51,14 +56,24 @@ class PricingModel(object):
     def get_price_discount(self):
         return Currency.get_price(self._get_discount_price())
 
+    def _get_converted_fprice(self, name):
+        # formatted prices filled by Currency.convert_prices
+        try:
+            currency_code, fprices = self._fprices
+        except AttributeError:
+            return None
+        if currency_code != Currency.get_default_currency().code:
+            return None
+        return fprices.get(name)
+
     def get_fprice(self):
-        return Currency.get_fprice(self.get_price(), True)
+        return self._get_converted_fprice('fprice') or Currency.get_fprice(self.get_price(), True)
 
     def get_fprice_real(self):
-        return Currency.get_fprice(self.get_price_real(), True)
+        return self._get_converted_fprice('fprice_real') or Currency.get_fprice(self.get_price_real(), True)
 
     def get_fprice_discount(self):
-        return Currency.get_fprice(self.get_price_discount(), True)
+        return self._get_converted_fprice('fprice_discount') or Currency.get_fprice(self.get_price_discount(), True)
 
     def get_discount_percent(self):
         discount = self.get_price_discount()
@@ -100,6 +115,7 @@ class ProductAbstract(models.Model, PricingModel):
     price = models.DecimalField(_('price'), max_digits=12, decimal_places=2, default=0)
     weight = models.FloatField(_('weight'), default=0, blank=True)
     discount_price = models.DecimalField(_('discount price'), max_digits=12, decimal_places=2, blank=True, null=True)
+    min_price = models.DecimalField(_('min price'), max_digits=12, decimal_places=2, default=0, editable=False, db_index=True)
     description = models.TextField(_('description'), default='', blank=True)
     image = ThumbnailerImageField(_('image'), upload_to=upload_to_slugify('products/main'), blank=True)
 
@@ -112,6 +128,9 @@ class ProductAbstract(models.Model, PricingModel):
 
     sort = models.IntegerField(_('sort'), default=0)
 
+    if STOCK_RESERVATION_ENABLED:
+        stock = models.PositiveIntegerField(_('in stock'), default=0)
+
     objects = models.Manager()
     in_category_objects = CategoryManager()
 
@@ -141,7 +160,7 @@ class ProductAbstract(models.Model, PricingModel):
     admin_price_display.short_description = _(u'price')
 
     def get_absolute_url(self):
-        if hasattr(self, '_current_category'):
+        if hasattr(self, '_current_category') or hasattr(self, 'absolute_url'):
             return self.get_absolute_url_slow()
         else:
             return self.get_absolute_url_fast()
@@ -158,7 +177,65 @@ class ProductAbstract(models.Model, PricingModel):
             return self.absolute_url
 
     def get_absolute_url_fast(self):
-        return reverse('redirect_to_product', kwargs={'product_id': self.pk})
+        Product.prefetch_absolute_urls([self])
+        return self.absolute_url
+
+    @classmethod
+    def resolve_articul(cls, articul):
+        """
+        Returns (product id, category ids, hidden) of product with given
+        articul or None. If QSHOP_ARTICUL_CACHE_ENABLED, found articuls are
+        cached (reset on product and category changes) and missing ones are
+        cached for a short time, if they are valid.
+        """
+        if ARTICUL_CACHE_ENABLED:
+            cache = get_cache()
+            cache_key = articul_cache_key(articul)
+            data = cache.get(cache_key)
+            if data is not None:
+                return data or None
+
+        product = cls.objects.filter(articul=articul).values_list('pk', 'hidden').first()
+        if product:
+            category_ids = list(Menu.objects.filter(product__id=product[0]).values_list('pk', flat=True))
+            data = (product[0], category_ids, product[1])
+            if ARTICUL_CACHE_ENABLED:
+                cache.set(cache_key, data, ARTICUL_CACHE_TIMEOUT)
+        else:
+            data = ()
+            if ARTICUL_CACHE_ENABLED and re.match(r'^[A-Za-z0-9_.-]+\Z', articul):
+                cache.set(cache_key, data, ARTICUL_NOT_FOUND_CACHE_TIMEOUT)
+        return data or None
+
+    @classmethod
+    def prefetch_absolute_urls(cls, products):
+        """
+        Sets canonical urls (in first enabled category) of products. Urls are
+        kept in cache and reset on category, menu and product changes, missing
+        ones are resolved with one query.
+        """
+        products = [product for product in products if not hasattr(product, 'absolute_url')]
+        if not products:
+            return
+        cache = get_cache()
+        keys = product_url_cache_keys([product.pk for product in products])
+        urls = cache.get_many(list(keys.values()))
+        missing = [product for product in products if keys[product.pk] not in urls]
+        if missing:
+            categories_urls = {}
+            for product_id, full_url in Menu.objects.filter(enabled=True, product__in=missing).values_list('product', 'full_url'):
+                categories_urls.setdefault(product_id, full_url)
+            missing_urls = {}
+            for product in missing:
+                if product.pk in categories_urls:
+                    url = "%s%s/" % (categories_urls[product.pk], product.articul)
+                else:
+                    url = ''
+                missing_urls[keys[product.pk]] = reverse('dispatcher', kwargs={'url': url})
+            cache.set_many(missing_urls, PRODUCT_URL_CACHE_TIMEOUT)
+            urls.update(missing_urls)
+        for product in products:
+            product.absolute_url = urls[keys[product.pk]]
 
     def get_current_category(self):
         try:
@@ -173,9 +250,26 @@ class ProductAbstract(models.Model, PricingModel):
     def __init__(self, *args, **kwargs):
         super(ProductAbstract, self).__init__(*args, **kwargs)
         self.old_parameters_set_id = self.parameters_set_id
+        self.old_articul = self.__dict__.get('articul')
 
-    # def save(self, skip_variations=False, *args, **kwargs):
-    #     super(Product, self).save(*args, **kwargs)
+    def save(self, *args, **kwargs):
+        self.min_price = self.get_min_price()
+        super(ProductAbstract, self).save(*args, **kwargs)
+
+    def get_min_price(self):
+        """
+        Returns price used for sorting: the lowest of discount/regular price
+        over product variations or of the product itself.
+        """
+        if self.pk:
+            prices = [variation.discount_price or variation.price for variation in self.productvariation_set.all()]
+            if prices:
+                return min(prices)
+        return self.discount_price or self.price
+
+    def update_min_price(self):
+        self.min_price = self.get_min_price()
+        Product.objects.filter(pk=self.pk).update(min_price=self.min_price)
 
     def _get_price(self):
         if self.selected_variation:
@@ -191,10 +285,14 @@ class ProductAbstract(models.Model, PricingModel):
         if not self.has_variations:
             return False
         try:
-            variation = ProductVariation.objects.get(pk=variation_id)
-        except ProductVariation.DoesNotExist:
+            if hasattr(self, '_get_variations'):
+                variation = [variation for variation in self._get_variations if str(variation.pk) == str(variation_id)][0]
+            else:
+                variation = ProductVariation.objects.get(pk=variation_id)
+        except (ProductVariation.DoesNotExist, IndexError):
             variation = ProductVariation.objects.filter(product=self)[0]
         self.selected_variation = variation
+        self.__dict__.pop('_fprices', None)
         return True
 
     def has_parameters(self):
@@ -248,9 +346,65 @@ class ProductAbstract(models.Model, PricingModel):
             # self._get_variations = self.productvariation_set.all()
             return self._get_variations
 
+    @classmethod
+    def prefetch_page_data(cls, products, category=None):
+        """
+        Loads variations, additional images and parameters of all products
+        with one query each and puts them where get_variations(),
+        get_additional_images() and get_parameters() look for them.
+        Variations are loaded only for products with has_variations.
+        If category is given it becomes current category of products.
+        """
+        products_with_variations = []
+        for product in products:
+            if product.has_variations:
+                products_with_variations.append(product)
+            else:
+                product._get_variations = []
+        models.prefetch_related_objects(
+            products_with_variations,
+            models.Prefetch(
+                'productvariation_set',
+                queryset=ProductVariation.objects.select_related('variation'),
+                to_attr='_get_variations'
+            ),
+        )
+        models.prefetch_related_objects(
+            products,
+            models.Prefetch('productimage_set', to_attr='_additional_images'),
+            models.Prefetch(
+                'producttoparameter_set',
+                queryset=ProductToParameter.objects.select_related('parameter', 'value').order_by('parameter__order').exclude(value=None),
+                to_attr='_parameters_for_product'
+            ),
+        )
+        if category is not None:
+            for product in products:
+                product._current_category = category
+        return products
+
+    def get_stock_object(self):
+        """
+        Returns product or its selected variation, which keeps stock.
+        """
+        if self.has_variations and self.selected_variation:
+            return self.selected_variation
+        return self
+
     def can_be_purchased(self, quantity):
+        if STOCK_RESERVATION_ENABLED:
+            return self.get_stock_object().stock >= int(quantity)
         return True
 
+    @classmethod
+    def can_be_purchased_bulk(cls, lines):
+        """
+        lines - list of (product with selected variation, quantity).
+        Returns list of products which can't be purchased, override to check
+        stock of all lines with one query.
+        """
+        return [product for product, quantity in lines if not product.can_be_purchased(quantity)]
+
 
 class ProductVariationValueAbstract(models.Model):
     _translation_fields = ['value']
@@ -276,14 +430,19 @@ class ProductVariationAbstract(models.Model, PricingModel):
     discount_price = models.DecimalField(_('discount price'), max_digits=12, decimal_places=2, blank=True, null=True)
     sort = models.IntegerField(_('sort'), default=0)
 
+    if STOCK_RESERVATION_ENABLED:
+        stock = models.PositiveIntegerField(_('in stock'), default=0)
+
     class Meta:
         verbose_name = _('product variation')
         verbose_name_plural = _('product variations')
         ordering = ['sort']
         abstract = True
 
-    def save(self, skip_variations=False, *args, **kwargs):
+    def save(self, skip_variations=False, update_min_price=True, *args, **kwargs):
         super(ProductVariationAbstract, self).save(*args, **kwargs)
+        if update_min_price:
+            self.product.update_min_price()
 
     def __str__(self):
         return "%s" % self.price
@@ -323,6 +482,7 @@ class ParametersSetAbstract(models.Model):
     def save(self, *args, **kwargs):
         super(ParametersSetAbstract, self).save(*args, **kwargs)
         parameters = set(Parameter.objects.filter(parameters_set=self).values_list('id', flat=True))
+        changed = False
         for product_id in Product.objects.filter(parameters_set=self).values_list('id', flat=True):
             product_parameters = set(Parameter.objects.filter(producttoparameter__product_id=product_id).values_list('id', flat=True))
 
@@ -338,9 +498,15 @@ class ParametersSetAbstract(models.Model):
                         value_id=None
                     ))
                 ProductToParameter.objects.bulk_create(add_parameters_objects)
+                changed = True
 
             if del_parameters:
                 ProductToParameter.objects.filter(parameter_id__in=del_parameters, product_id=product_id).delete()
+                changed = True
+
+        if changed:
+            # bulk_create doesn't send signals, cached filters and counts are reset here
+            bump_generation('catalog')
 
 
 class ParameterAbstract(models.Model):
@@ -401,6 +567,15 @@ class ProductToParameterAbstract(models.Model):
         return 'Product Field Nr. %d' % self.parameter_id
 
 
+# currency of current request (set by CurrencyMiddleware), contextvar keeps it
+# separate for every thread and asyncio task
+current_currency = ContextVar('qshop_current_currency', default=None)
+
+# all currencies (and their rates as Decimal) loaded once per process and
+# reloaded after CURRENCY_CACHE_TIMEOUT or on Currency change
+currencies_cache = {'currencies': None, 'rates': {}, 'expires': 0}
+
+
 class CurrencyAbstract(models.Model):
     code = models.CharField(_('code'), max_length=3, db_index=True)
     name = models.CharField(_('currency name'), max_length=12)
@@ -409,8 +584,6 @@ class CurrencyAbstract(models.Model):
     show_string = models.CharField(_('show string'), max_length=64)
     is_default = models.BooleanField(_('is default'), default=False)
 
-    current_currency = None
-
     class Meta:
         verbose_name = _('currency')
         verbose_name_plural = _('currencies')
@@ -433,24 +606,83 @@ class CurrencyAbstract(models.Model):
             price = Currency.get_default_currency().get_price(price)
         return mark_safe(str(Currency.get_default_currency().show_string) % price)
 
-    # TODO fix per-session independence
     @staticmethod
     def get_default_currency():
-        if not Currency.current_currency:
-            Currency.current_currency = Currency.get_default_currency_notoverloadable()
-        return Currency.current_currency
+        currency = current_currency.get()
+        if currency is None:
+            currency = Currency.get_default_currency_notoverloadable()
+        return currency
 
     @staticmethod
     def set_default_currency(currency):
-        Currency.current_currency = currency
+        """
+        Returns token for reset_default_currency().
+        """
+        return current_currency.set(currency)
+
+    @staticmethod
+    def reset_default_currency(token):
+        try:
+            current_currency.reset(token)
+        except ValueError:
+            # token is from other context (sync middleware in async stack)
+            current_currency.set(None)
 
     @staticmethod
     def get_default_currency_notoverloadable():
+        for currency in Currency.get_currencies().values():
+            if currency.is_default:
+                return currency
         return Currency.objects.filter(is_default=True)[0]
 
+    @staticmethod
+    def get_currencies():
+        """
+        Returns {code: currency} of all currencies in their sorting.
+        """
+        currencies = currencies_cache['currencies']
+        if currencies is None or currencies_cache['expires'] < time.monotonic():
+            currencies = {currency.code: currency for currency in Currency.objects.all()}
+            currencies_cache['currencies'] = currencies
+            currencies_cache['rates'] = {code: Decimal(str(currency.rate)) for code, currency in currencies.items()}
+            currencies_cache['expires'] = time.monotonic() + CURRENCY_CACHE_TIMEOUT
+        return currencies
+
+    @staticmethod
+    def get_currency_by_code(code):
+        return Currency.get_currencies().get(code)
+
+    @staticmethod
+    def reset_currencies_cache():
+        currencies_cache['currencies'] = None
+
+    def get_rate(self):
+        try:
+            return currencies_cache['rates'][self.code]
+        except KeyError:
+            return Decimal(str(self.rate))
+
+    @staticmethod
+    def convert_prices(items):
+        """
+        Formats prices of products or variations in current currency once
+        (through the same get_price*/Currency.get_fprice calls as single
+        items), get_fprice, get_fprice_real and get_fprice_discount of items
+        then return ready strings.
+        """
+        currency = Currency.get_default_currency()
+        for item in items:
+            discount_price = item.get_price_discount()
+            item._fprices = (currency.code, {
+                'fprice': Currency.get_fprice(item.get_price(), True),
+                'fprice_real': Currency.get_fprice(item.get_price_real(), True),
+                'fprice_discount': Currency.get_fprice(discount_price, True) if discount_price is not None else None,
+            })
+        return items
+
     @staticmethod
     def get_price_notoverloadable(price):
-        return float(price) / Currency.get_default_currency().rate
+        return float(Decimal(str(price)) / Currency.get_default_currency().get_rate())
 
 
 class PromoCodeAbstract(models.Model):
@@ -0,0 +1,191 @@
+import base64
+import json
+from math import ceil
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from .cache import get_cache
+
+
+def encode_cursor(direction, values):
+    data = json.dumps(values, default=str, separators=(',', ':')).encode('utf-8')
+    return direction + base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    direction, data = cursor[:1], cursor[1:]
+    if direction not in ('n', 'p') or not data:
+        raise PageNotAnInteger('Invalid page cursor')
+    try:
+        values = json.loads(base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8'))
+    except ValueError:
+        raise PageNotAnInteger('Invalid page cursor')
+    if not isinstance(values, list):
+        raise PageNotAnInteger('Invalid page cursor')
+    return direction, values
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+def seek_filter(ordering, values):
+    """
+    Returns Q selecting rows which go after row with given values of ordering fields.
+    """
+    q = Q()
+    for i, field in enumerate(ordering):
+        lookup = '{0}__lt'.format(field[1:]) if field.startswith('-') else '{0}__gt'.format(field)
+        condition = Q(**{lookup: values[i]})
+        for previous_field, value in zip(ordering[:i], values):
+            condition &= Q(**{previous_field.lstrip('-'): value})
+        q |= condition
+    return q
+
+
+def get_cached_count(cache_key, timeout, get_count):
+    if cache_key is None:
+        return get_count()
+    cache = get_cache()
+    count = cache.get(cache_key)
+    if count is None:
+        count = get_count()
+        cache.set(cache_key, count, timeout)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator keeping total count of objects in cache under count_cache_key,
+    so COUNT query is not repeated while navigating pages of the same list.
+    """
+
+    def __init__(self, object_list, per_page, count_cache_key=None, count_cache_timeout=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_cache_key = count_cache_key
+        self.count_cache_timeout = count_cache_timeout
+
+    @cached_property
+    def count(self):
+        return get_cached_count(self.count_cache_key, self.count_cache_timeout, lambda: super(CachedCountPaginator, self).count)
+
+
+class KeysetPaginator:
+    """
+    Paginator which seeks on values of ordering fields instead of using
+    OFFSET and does not need COUNT query. Pages are addressed by cursors:
+    'n<values>' - page after row with values, 'p<values>' - page before it.
+    The only numeric page is 1, other numbers (old links) would need OFFSET
+    and raise EmptyPage.
+
+    ordering must end with unique field (id) and contain only own not null
+    fields of model.
+    Total count is only queried when asked for and is cached like in
+    CachedCountPaginator.
+    """
+
+    def __init__(self, object_list, per_page, ordering, count_cache_key=None, count_cache_timeout=None):
+        self.object_list = object_list.order_by(*ordering)
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+        self.count_cache_key = count_cache_key
+        self.count_cache_timeout = count_cache_timeout
+
+    @cached_property
+    def count(self):
+        return get_cached_count(self.count_cache_key, self.count_cache_timeout, self.object_list.count)
+
+    @property
+    def num_pages(self):
+        return max(int(ceil(self.count / float(self.per_page))), 1)
+
+    def get_values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    def clean_values(self, values):
+        """
+        Converts cursor values (they come from url) to python values of
+        ordering fields, raises PageNotAnInteger on any wrong value.
+        """
+        if len(values) != len(self.ordering):
+            raise PageNotAnInteger('Invalid page cursor')
+        cleaned = []
+        for field_name, value in zip(self.ordering, values):
+            if value is None or isinstance(value, (list, dict)):
+                raise PageNotAnInteger('Invalid page cursor')
+            try:
+                value = self.object_list.model._meta.get_field(field_name.lstrip('-')).to_python(value)
+            except (FieldDoesNotExist, ValidationError, ValueError, TypeError):
+                raise PageNotAnInteger('Invalid page cursor')
+            if value is None:
+                raise PageNotAnInteger('Invalid page cursor')
+            cleaned.append(value)
+        return cleaned
+
+    def page(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            direction, values = decode_cursor(str(number))
+            values = self.clean_values(values)
+        else:
+            if number != 1:
+                raise EmptyPage('Only first page can be numeric')
+            objects = list(self.object_list[:self.per_page + 1])
+            return KeysetPage(objects[:self.per_page], self, has_next=len(objects) > self.per_page, has_previous=False)
+
+        if direction == 'n':
+            objects = list(self.object_list.filter(seek_filter(self.ordering, values))[:self.per_page + 1])
+            if not objects:
+                raise EmptyPage('That page contains no results')
+            return KeysetPage(objects[:self.per_page], self, has_next=len(objects) > self.per_page, has_previous=True)
+
+        ordering = reverse_ordering(self.ordering)
+        objects = list(self.object_list.filter(seek_filter(ordering, values)).order_by(*ordering)[:self.per_page + 1])
+        if len(objects) <= self.per_page:
+            # reached the beginning, show full first page instead of a short one
+            return self.page(1)
+        objects = objects[:self.per_page]
+        objects.reverse()
+        return KeysetPage(objects, self, has_next=True, has_previous=True)
+
+
+class KeysetPage:
+    number = None
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Keyset page>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage('That page contains no results')
+        return encode_cursor('n', self.paginator.get_values(self.object_list[-1]))
+
+    def previous_page_number(self):
+        if not self._has_previous:
+            raise EmptyPage('That page number is less than 1')
+        return encode_cursor('p', self.paginator.get_values(self.object_list[0]))
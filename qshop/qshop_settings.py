@@ -7,6 +7,14 @@ if not 'sitemenu' in settings.INSTALLED_APPS:
     raise Exception('Error! qShop requires django-sitemenu!')
 
 PRODUCTS_ON_PAGE = getattr(settings, 'QSHOP_PRODUCTS_ON_PAGE', 10)
+# load parameters, variations and additional images of all products on listing page with one query each
+# (for templates showing them in products list)
+PRODUCTS_PREFETCH_PAGE_DATA = getattr(settings, 'QSHOP_PRODUCTS_PREFETCH_PAGE_DATA', False)
+# 'offset' - numbered pages, 'keyset' - pages are cursors seeking on sorting fields (no OFFSET and COUNT on every page)
+PAGINATION_TYPE = getattr(settings, 'QSHOP_PAGINATION_TYPE', 'offset')
+# cache total count of products of category listing for this time (it is also reset on catalog changes)
+PAGINATION_COUNT_CACHE_ENABLED = getattr(settings, 'QSHOP_PAGINATION_COUNT_CACHE_ENABLED', False)
+PAGINATION_COUNT_CACHE_TIMEOUT = getattr(settings, 'QSHOP_PAGINATION_COUNT_CACHE_TIMEOUT', 60 * 15)
 PRODUCT_ADMIN_CATEGORY_CHECKBOX_WIDGET_ENABLED = getattr(settings, 'QSHOP_PRODUCT_ADMIN_CATEGORY_CHECKBOX_WIDGET_ENABLED', False)
 
 
@@ -23,9 +31,28 @@ PARAMETER_VALUE_CLASS = getattr(settings, 'QSHOP_PARAMETER_VALUE_CLASS', None)
 PRODUCT_TO_PARAMETER_CLASS = getattr(settings, 'QSHOP_PRODUCT_TO_PARAMETER_CLASS', None)
 
 CURRENCY_CLASS = getattr(settings, 'QSHOP_CURRENCY_CLASS', None)
+# currencies are kept in memory of every process, changes made in other processes are seen after this time
+CURRENCY_CACHE_TIMEOUT = getattr(settings, 'QSHOP_CURRENCY_CACHE_TIMEOUT', 60)
 
 LOAD_ADDITIONAL_MODELS = getattr(settings, 'QSHOP_LOAD_ADDITIONAL_MODELS', None)
 
+CACHE_ALIAS = getattr(settings, 'QSHOP_CACHE_ALIAS', 'default')
+# canonical product urls are cached for this time (they are also reset on category and menu changes)
+PRODUCT_URL_CACHE_TIMEOUT = getattr(settings, 'QSHOP_PRODUCT_URL_CACHE_TIMEOUT', 60 * 60 * 24)
+# cache product id, categories and visibility by articul, so unknown articuls on product pages get 404 without
+# product query (entries are reset on product and category changes, so cache must be shared by all processes)
+ARTICUL_CACHE_ENABLED = getattr(settings, 'QSHOP_ARTICUL_CACHE_ENABLED', False)
+ARTICUL_CACHE_TIMEOUT = getattr(settings, 'QSHOP_ARTICUL_CACHE_TIMEOUT', 60 * 60 * 24)
+# missing articuls are cached for this time (only ones which are valid articuls, not any unknown url)
+ARTICUL_NOT_FOUND_CACHE_TIMEOUT = getattr(settings, 'QSHOP_ARTICUL_NOT_FOUND_CACHE_TIMEOUT', 60 * 5)
+# serve products export (csv, jsonl, merchant feed xml) at shop-export/<format>/ to staff users
+# and to requests with ?token=EXPORT_VIEW_TOKEN (e.g. merchant center fetching the feed)
+EXPORT_VIEW_ENABLED = getattr(settings, 'QSHOP_EXPORT_VIEW_ENABLED', False)
+EXPORT_VIEW_TOKEN = getattr(settings, 'QSHOP_EXPORT_VIEW_TOKEN', None)
+# if set, view serves files products.<format> from this dir (made by qshop_export_products --output) instead of
+# generating export on every request
+EXPORT_VIEW_FILES_DIR = getattr(settings, 'QSHOP_EXPORT_VIEW_FILES_DIR', None)
+
 
 CART_CLASS = getattr(settings, 'QSHOP_CART_CLASS', None) # cart class
 CART_ORDER_CLASS = getattr(settings, 'QSHOP_CART_ORDER_CLASS', None) # cart model
@@ -38,6 +65,10 @@ CART_ORDER_VIEW = getattr(settings, 'QSHOP_CART_ORDER_VIEW', False)
 
 CART_TABLE_LINK_ADD = getattr(settings, 'QSHOP_CART_TABLE_LINK_ADD', None)
 CART_TABLE_IMAGE_ADD = getattr(settings, 'QSHOP_CART_TABLE_IMAGE_ADD', None)
+# cart items are repriced only when product prices were changed since last repricing (generation in cache is
+# bumped by product save signals, so use only with cache shared by all processes and without prices changed by
+# queryset updates or raw sql)
+CART_REPRICE_ON_PRICE_CHANGE_ONLY = getattr(settings, 'QSHOP_CART_REPRICE_ON_PRICE_CHANGE_ONLY', False)
 
 
 # DELIVERY OPTIONS
@@ -104,8 +135,28 @@ VARIATION_FILTER_NAME = getattr(settings, 'QSHOP_VARIATION_FILTER_NAME', _('Vari
 
 FILTER_BY_VARIATION_TYPE = getattr(settings, 'QSHOP_FILTER_BY_VARIATION_TYPE', 'and')
 
+# keep filters (names and values) of every category in cache, invalidated by product/parameter/variation changes
+FILTERS_CACHE_ENABLED = getattr(settings, 'QSHOP_FILTERS_CACHE_ENABLED', False)
+FILTERS_CACHE_TIMEOUT = getattr(settings, 'QSHOP_FILTERS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# 'database' - filter products with joins in SQL
+# 'bitmap' - resolve filters in memory with per category bitsets kept in cache and fetch only products of current page
+#            (needs QSHOP_FILTERS_CACHE_ENABLED, without it 'database' engine is used)
+FILTERS_ENGINE = getattr(settings, 'QSHOP_FILTERS_ENGINE', 'database')
+
+# cache whole rendered category and product pages for anonymous visitors without cart
+PAGE_CACHE_ENABLED = getattr(settings, 'QSHOP_PAGE_CACHE_ENABLED', False)
+PAGE_CACHE_TIMEOUT = getattr(settings, 'QSHOP_PAGE_CACHE_TIMEOUT', 60 * 60)
+# cache parts of products page wrapped with {% qshop_cache productdata 'name' %} for all visitors
+FRAGMENT_CACHE_ENABLED = getattr(settings, 'QSHOP_FRAGMENT_CACHE_ENABLED', False)
+
 CART_DELIVERY_FUNCTION = getattr(settings, 'QSHOP_CART_DELIVERY_FUNCTION', 'qshop.cart.overloadable_functions.count_delivery_price')
 
+# products and variations get stock field, stock of all cart items is reserved in one transaction at checkout
+STOCK_RESERVATION_ENABLED = getattr(settings, 'QSHOP_STOCK_RESERVATION_ENABLED', False)
+# reservations of unpaid orders are released after this time by qshop_release_stock command
+STOCK_RESERVATION_TIMEOUT = getattr(settings, 'QSHOP_STOCK_RESERVATION_TIMEOUT', 60 * 30)
+
 
 ##### payments
 ENABLE_PAYMENTS = getattr(settings, 'QSHOP_ENABLE_PAYMENTS', False)
@@ -0,0 +1,128 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from sitemenu import import_item
+from sitemenu.sitemenu_settings import MENUCLASS
+
+from .cache import bump_categories, bump_generation, delete_articuls, delete_product_urls
+from .models import (
+    Currency,
+    Parameter,
+    ParametersSet,
+    ParameterValue,
+    Product,
+    ProductToParameter,
+    ProductVariation,
+    ProductVariationValue,
+)
+from .qshop_settings import FILTERS_FIELDS
+
+Menu = import_item(MENUCLASS)
+
+
+def get_product_categories(product_id):
+    return Menu.objects.filter(product__id=product_id).values_list('pk', flat=True)
+
+
+@receiver(post_save, sender=Product)
+@receiver(pre_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    bump_categories(get_product_categories(instance.pk))
+
+
+@receiver(post_save, sender=ProductToParameter)
+@receiver(post_delete, sender=ProductToParameter)
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+def invalidate_product_relation(sender, instance, **kwargs):
+    bump_categories(get_product_categories(instance.product_id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+def invalidate_prices(sender, **kwargs):
+    # carts reprice their items when this generation changes
+    bump_generation('prices')
+
+
+@receiver(post_delete, sender=ProductVariation)
+def update_product_min_price(sender, instance, **kwargs):
+    product = Product.objects.filter(pk=instance.product_id).first()
+    if product:
+        product.update_min_price()
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def invalidate_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            bump_categories([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        bump_categories(pk_set)
+    elif action == 'pre_clear':
+        bump_categories(get_product_categories(instance.pk))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_url(sender, instance, **kwargs):
+    delete_product_urls([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_articul(sender, instance, **kwargs):
+    delete_articuls([instance.articul, instance.old_articul])
+    instance.old_articul = instance.articul
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def invalidate_product_categories_data(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        bump_generation('articuls')
+        if action == 'post_clear':
+            bump_generation('urls')
+        else:
+            delete_product_urls(pk_set)
+    else:
+        delete_articuls([instance.articul])
+        delete_product_urls([instance.pk])
+
+
+def invalidate_catalog(sender, **kwargs):
+    bump_generation('catalog')
+
+
+catalog_models = [ParametersSet, Parameter, ParameterValue, ProductVariationValue]
+if FILTERS_FIELDS:
+    for field_name in dict(FILTERS_FIELDS).values():
+        catalog_models.append(Product._meta.get_field(field_name).related_model)
+
+for catalog_model in catalog_models:
+    post_save.connect(invalidate_catalog, sender=catalog_model, dispatch_uid='qshop_catalog_save_{0}'.format(catalog_model.__name__))
+    post_delete.connect(invalidate_catalog, sender=catalog_model, dispatch_uid='qshop_catalog_delete_{0}'.format(catalog_model.__name__))
+
+
+def invalidate_pages(sender, **kwargs):
+    bump_generation('pages')
+
+
+def invalidate_urls(sender, **kwargs):
+    bump_generation('urls')
+
+
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def reset_currencies(sender, **kwargs):
+    Currency.reset_currencies_cache()
+
+
+for pages_model in [Menu, Currency]:
+    post_save.connect(invalidate_pages, sender=pages_model, dispatch_uid='qshop_pages_save_{0}'.format(pages_model.__name__))
+    post_delete.connect(invalidate_pages, sender=pages_model, dispatch_uid='qshop_pages_delete_{0}'.format(pages_model.__name__))
+
+post_save.connect(invalidate_urls, sender=Menu, dispatch_uid='qshop_urls_save_menu')
+post_delete.connect(invalidate_urls, sender=Menu, dispatch_uid='qshop_urls_delete_menu')
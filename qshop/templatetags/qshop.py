@@ -1,7 +1,9 @@
 from django import template
 from ..models import Currency
-from ..cart.cart import Cart
+from ..cart.cart import get_cart
 from ..functions import get_catalogue_root
+from ..cache import get_cache
+from ..qshop_settings import FRAGMENT_CACHE_ENABLED, PAGE_CACHE_TIMEOUT
 register = template.Library()
 
 
@@ -12,7 +14,7 @@ register = template.Library()
 
 @register.simple_tag(takes_context=True)
 def qshop_cart_products(context, as_var=None):
-    cart = Cart(context['request'])
+    cart = get_cart(context['request'])
     if as_var:
         context[as_var] = cart.get_products()
         return ''
@@ -21,7 +23,7 @@ def qshop_cart_products(context, as_var=None):
 
 @register.simple_tag(takes_context=True)
 def qshop_items_in_cart_with_qty(context, as_var=None):
-    cart = Cart(context['request'])
+    cart = get_cart(context['request'])
     if as_var:
         context[as_var] = cart.total_products_with_qty()
         return ''
@@ -30,7 +32,7 @@ def qshop_items_in_cart_with_qty(context, as_var=None):
 
 @register.simple_tag(takes_context=True)
 def qshop_items_in_cart(context, as_var=None):
-    cart = Cart(context['request'])
+    cart = get_cart(context['request'])
     if as_var:
         context[as_var] = cart.total_products()
         return ''
@@ -49,12 +51,22 @@ def set_catalogue_root(context):
 @register.simple_tag(takes_context=True)
 def set_currencies_list(context):
     context['current_currency'] = Currency.get_default_currency()
-    context['currencies_list'] = Currency.objects.all()
+    context['currencies_list'] = list(Currency.get_currencies().values())
     return ''
 
+@register.simple_tag
+def qshop_convert_prices(items):
+    """
+    {% qshop_convert_prices productdata.products_page.object_list %}
+    Prepares formatted prices of all items at once.
+    """
+    Currency.convert_prices(items)
+    return ''
+
+
 @register.simple_tag(takes_context=True)
 def qshop_cart_total_price(context, as_var=None):
-    cart = Cart(context['request'])
+    cart = get_cart(context['request'])
     if as_var:
         context[as_var] = round(cart.total_price(), 2)
         return ''
@@ -62,8 +74,46 @@ def qshop_cart_total_price(context, as_var=None):
 
 @register.simple_tag(takes_context=True)
 def qshop_cart_currency(context, as_var=None):
-    cart = Cart(context['request'])
+    cart = get_cart(context['request'])
     if as_var:
         context[as_var] = cart.get_currency()
         return ''
     return cart.get_currency()
+
+
+class QshopCacheNode(template.Node):
+    def __init__(self, nodelist, productdata, name):
+        self.nodelist = nodelist
+        self.productdata = productdata
+        self.name = name
+
+    def render(self, context):
+        if not FRAGMENT_CACHE_ENABLED:
+            return self.nodelist.render(context)
+
+        cache_key = self.productdata.resolve(context).get_fragment_cache_key(self.name.resolve(context))
+        if cache_key is None:
+            return self.nodelist.render(context)
+
+        cache = get_cache()
+        value = cache.get(cache_key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(cache_key, value, PAGE_CACHE_TIMEOUT)
+        return value
+
+
+@register.tag
+def qshop_cache(parser, token):
+    """
+    {% qshop_cache productdata 'products' %}...{% endqshop_cache %}
+
+    Caches part of products page if QSHOP_FRAGMENT_CACHE_ENABLED, the cache
+    is reset with the same signals as the filters cache.
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("'%s' tag requires productdata and fragment name" % bits[0])
+    nodelist = parser.parse(('endqshop_cache',))
+    parser.delete_first_token()
+    return QshopCacheNode(nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]))
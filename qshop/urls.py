@@ -1,6 +1,6 @@
 from django.urls import path, include
 
-from .views import redirect_to_product, set_currency
+from .views import export_products_view, redirect_to_product, set_currency
 from . import qshop_settings
 
 urlpatterns = [
@@ -9,6 +9,11 @@ urlpatterns = [
     path('shop-set-currency/<currency_code>/', set_currency, name='set_currency'),
 ]
 
+if qshop_settings.EXPORT_VIEW_ENABLED:
+    urlpatterns += [
+        path('shop-export/<export_format>/', export_products_view, name='export_products'),
+    ]
+
 if qshop_settings.ENABLE_PAYMENTS:
     urlpatterns += [
         path('vendors/', include('qshop.payment_vendors.urls')),
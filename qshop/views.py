@@ -1,13 +1,73 @@
-from django.http import Http404
+import hashlib
+import os
+
+from django.contrib.messages import get_messages
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import get_language
 
+from .cache import get_cache, page_cache_key, product_url_cache_keys
+from .cart.cart import CART_ID, CART_SESSION_ITEMS
 from .classes import CategoryData
+from .export import EXPORT_FORMATS, export_products
 from .functions import get_products_page_data
 from .models import Currency, Product
-from .qshop_settings import REDIRECT_CLASS
+from .qshop_settings import (
+    ARTICUL_CACHE_ENABLED, EXPORT_VIEW_FILES_DIR, EXPORT_VIEW_TOKEN, PAGE_CACHE_ENABLED, PAGE_CACHE_TIMEOUT, REDIRECT_CLASS
+)
+
+
+def can_cache_page(request, menu, products=None):
+    """
+    Only pages which look the same for every visitor are cached: anonymous
+    GET requests without cart and pending messages.
+    """
+    if not PAGE_CACHE_ENABLED or products is not None or menu.page_type == 'pdis':
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return False
+    session = getattr(request, 'session', None)
+    if session is not None and (session.get(CART_ID) or session.get(CART_SESSION_ITEMS)):
+        return False
+    if len(get_messages(request)):
+        return False
+    return True
+
+
+def get_page_cache_key(request, menu):
+    path_hash = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    return page_cache_key('page', menu.pk, Currency.get_default_currency().code, get_language(), path_hash)
+
+
+def can_cache_response(request, response):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return False
+    # page contains csrf token of current visitor
+    if request.META.get('CSRF_COOKIE_USED') or request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+        return False
+    return True
 
 
 def render_shopspage(request, menu, url_add, products=None):
+    if not can_cache_page(request, menu, products):
+        return _render_shopspage(request, menu, url_add, products)
+
+    cache = get_cache()
+    cache_key = get_page_cache_key(request, menu)
+    response = cache.get(cache_key)
+    if response is None:
+        response = _render_shopspage(request, menu, url_add, products)
+        if can_cache_response(request, response):
+            cache.set(cache_key, response, PAGE_CACHE_TIMEOUT)
+    return response
+
+
+def _render_shopspage(request, menu, url_add, products=None):
     filter_string, page_num, sort, show_product = get_products_page_data(url_add)
 
     if not show_product:
@@ -30,7 +90,11 @@ def render_shopspage(request, menu, url_add, products=None):
         if len(url_add) != 1:
             raise Http404('wrong url_add')
 
+        # cached articuls only answer unknown ones, visibility is always checked by query
+        if ARTICUL_CACHE_ENABLED and not Product.resolve_articul(url_add[0]):
+            raise Http404('No product found')
         product = get_object_or_404(Product, articul=url_add[0], category=menu, hidden=False)
+        Product.prefetch_page_data([product], category=menu)
 
         menu._page_title = product.name
 
@@ -42,8 +106,17 @@ def render_shopspage(request, menu, url_add, products=None):
 
 
 def redirect_to_product(request, product_id):
-    product = get_object_or_404(Product, pk=product_id)
-    return REDIRECT_CLASS(product.get_absolute_url_slow())
+    try:
+        product_id = int(product_id)
+    except ValueError:
+        raise Http404('Wrong product id')
+    url = get_cache().get(product_url_cache_keys([product_id])[product_id])
+    if url is None:
+        articul = Product.objects.filter(pk=product_id).values_list('articul', flat=True).first()
+        if articul is None:
+            raise Http404('No product found')
+        url = Product(pk=product_id, articul=articul).get_absolute_url_fast()
+    return REDIRECT_CLASS(url)
 
 
 def set_currency(request, currency_code=None):
@@ -53,6 +126,34 @@ def set_currency(request, currency_code=None):
 
     currency = get_object_or_404(Currency, code=currency_code)
 
+    if request.session.get('currency') != currency.code:
+        request.session['currency'] = currency.code
     Currency.set_default_currency(currency)
 
     return REDIRECT_CLASS(redirect_url)
+
+
+def can_see_export(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = request.GET.get('token')
+    return bool(EXPORT_VIEW_TOKEN and token and constant_time_compare(token, EXPORT_VIEW_TOKEN))
+
+
+def export_products_view(request, export_format):
+    if export_format not in EXPORT_FORMATS:
+        raise Http404('Unknown export format')
+    if not can_see_export(request):
+        raise PermissionDenied
+    content_type = EXPORT_FORMATS[export_format][1]
+    if EXPORT_VIEW_FILES_DIR:
+        try:
+            export_file = open(os.path.join(EXPORT_VIEW_FILES_DIR, 'products.%s' % export_format), 'rb')
+        except IOError:
+            raise Http404('Export is not generated')
+        response = FileResponse(export_file, content_type=content_type)
+    else:
+        response = StreamingHttpResponse(export_products(export_format), content_type=content_type)
+    response['Content-Disposition'] = 'inline; filename="products.%s"' % export_format
+    return response